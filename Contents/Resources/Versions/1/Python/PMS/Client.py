@@ -3,12 +3,15 @@
 #  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
 #
 
-import PMS
+import PMS, threading
 
 __major = 0
 __minor = 0
 __release = 0
 
+# The client version of the request being handled on each thread
+__requestVersion = threading.local()
+
 def __setVersion(versionString):
   global __major
   global __minor
@@ -17,22 +20,28 @@ def __setVersion(versionString):
     if versionString.find("-") > 0:
       versionString = versionString.split("-")[0]
     version = versionString.split(".")
-    __major = int(version[0])
-    __minor = int(version[1])
-    __release = int(version[2])
+    version = (int(version[0]), int(version[1]), int(version[2]))
   except:
-    __major = 0
-    __minor = 0
-    __release = 0
+    version = (0, 0, 0)
+  __requestVersion.version = version
+  __major, __minor, __release = version
+
+def __keepVersion():
+  # Requests that don't specify a version use the most recently set one for the whole request
+  __requestVersion.version = (__major, __minor, __release)
+
+def __version():
+  return getattr(__requestVersion, "version", (__major, __minor, __release))
 
 def MajorVersion():
-  return __major
+  return __version()[0]
   
 def MinorVersion():
-  return __minor
+  return __version()[1]
   
 def ReleaseVersion():
-  return __release
+  return __version()[2]
   
 def VersionAtLeast(major=0, minor=0, release=0):
+  (__major, __minor, __release) = __version()
   return ((__major > major) or ((__major == major) and (__minor > minor)) or ((__major == major) and (__minor == minor) and (__release >= release)))
\ No newline at end of file
@@ -15,6 +15,12 @@ __alive = False
 __shouldCreate = False
 __changed = False
 
+__commitInterval = None
+__commitStatements = None
+__pendingStatements = 0
+__lastCommitTime = 0
+__commitTimer = None
+
 ####################################################################################################
 
 class __cmd:
@@ -60,6 +66,7 @@ def __loadDBInThread():
   global __sqlQueue
   global __shouldCreate
   global __changed
+  global __pendingStatements
   
   # Connect to the database, marking __shouldCreate if necessary
   __alive = False
@@ -89,7 +96,9 @@ def __loadDBInThread():
         
       elif s.cmd == "SQL":
         ret = __db.execute(s.args[0], s.args[1])
-        __changed = not s.args[0].lower().startswith("select")
+        if not s.args[0].lower().startswith("select"):
+          __changed = True
+          __pendingStatements += 1
     
     # Catch exceptions
     except:
@@ -120,20 +129,71 @@ def __exec(s):
 
 def __commit():
   global __changed
+  global __pendingStatements
+  global __lastCommitTime
   __db.commit()
   PMS.Log("(Framework) Committed the database")
   __changed = False
+  __pendingStatements = 0
+  __lastCommitTime = time.time()
 
 ####################################################################################################
     
 def __rollback():
   global __changed
+  global __pendingStatements
   __db.rollback()
   PMS.Log("(Framework) Rolled back the database")
   __changed = False
+  __pendingStatements = 0
 
 ####################################################################################################
+
+def __groupCommit(force=False):
+  #
+  # Commit pending changes if the commit policy allows it, otherwise schedule a commit for when
+  # the commit interval has elapsed
+  #
+  global __commitTimer
+  if not __changed or __db is None:
+    return
   
+  # With no limits set, every change is committed straight away
+  due = __commitInterval is None and __commitStatements is None
+  if __commitStatements is not None and __pendingStatements >= __commitStatements:
+    due = True
+  if __commitInterval is not None:
+    remaining = __lastCommitTime + __commitInterval - time.time()
+    if remaining <= 0:
+      due = True
+  
+  if force or due:
+    Thread.Lock("Framework.DatabaseCommit", addToLog=False)
+    if __commitTimer is not None:
+      __commitTimer.cancel()
+      __commitTimer = None
+    Thread.Unlock("Framework.DatabaseCommit", addToLog=False)
+    Commit()
+  elif __commitInterval is not None:
+    Thread.Lock("Framework.DatabaseCommit", addToLog=False)
+    try:
+      if __commitTimer is None:
+        __commitTimer = Thread.CreateTimer(remaining, __scheduledCommit)
+    finally:
+      Thread.Unlock("Framework.DatabaseCommit", addToLog=False)
+
+####################################################################################################
+
+def __scheduledCommit():
+  global __commitTimer
+  Thread.Lock("Framework.DatabaseCommit", addToLog=False)
+  __commitTimer = None
+  Thread.Unlock("Framework.DatabaseCommit", addToLog=False)
+  if __changed and __db is not None:
+    Commit()
+
+####################################################################################################
+
 def Exec(sql, values=[]):
   global __db
   global __alive
@@ -151,6 +211,19 @@ def Commit():
   __exec(__cmd("Commit"))
 
 ####################################################################################################
+
+def SetCommitPolicy(interval=None, statements=None):
+  #
+  # By default, changes are committed after every request. Group commits instead commit once
+  # `interval` seconds have passed since the last commit, or once `statements` changes are waiting
+  # to be committed, whichever comes first. A limit left as None doesn't apply.
+  #
+  global __commitInterval
+  global __commitStatements
+  __commitInterval = interval
+  __commitStatements = statements
+
+####################################################################################################
   
 def Rollback():
   __exec(__cmd("Rollback"))
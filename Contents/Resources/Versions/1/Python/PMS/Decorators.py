@@ -5,6 +5,7 @@
 
 import PMS, Plugin, Thread, inspect, traceback, Locale, Dict, Objects, Datetime
 from Shortcuts import *
+from Constants import *
 
 ####################################################################################################
 
@@ -16,6 +17,14 @@ def handler(prefix, name, thumb="icon-default.png", art="art-default.png"):
   
 ####################################################################################################
 
+def cached_response(cacheTime=CACHE_1HOUR):
+  def pms_fwk_cachedresponse_wrapper(f):
+    Plugin.__setResponseCacheTime(f, cacheTime)
+    return f
+  return pms_fwk_cachedresponse_wrapper
+  
+####################################################################################################
+
 class thread(object):
   def __init__(self, f):
     self.f = f
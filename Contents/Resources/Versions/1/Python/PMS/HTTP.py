@@ -3,8 +3,8 @@
 #  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
 #
 
-import urllib, urllib2, cookielib, os, StringIO, gzip
-import PMS, Data, Datetime, Thread
+import urllib, urllib2, urlparse, httplib, cookielib, os, socket, StringIO, gzip, zlib, threading, time, Queue, heapq, random, sys
+import PMS, Plugin, Data, Datetime, Thread, Hash
 
 ####################################################################################################
 
@@ -13,9 +13,292 @@ __cookieJar   = cookielib.MozillaCookieJar()
 __passMgr     = urllib2.HTTPPasswordMgrWithDefaultRealm()
 __authHandler = urllib2.HTTPBasicAuthHandler(__passMgr)
 __cache       = {}
+__changedEntries = set()
+__cacheSize   = 16777216
+__cacheMemoryUsed = 0
+__compressCache = False
+__hotContent = {}
+__hotContentSize = 1048576
+__hotContentUsed = 0
+__sharedCache = False
+__sharedCacheMaxAge = 604800
+__sharedCleanupTime = 0
+__sharedConnections = threading.local()
+__requestsInProgress = {}
+__refreshesInProgress = set()
+__failureCacheTimes = {"ClientError": 60, "ServerError": 10, "ConnectionError": 10}
+__failedURLs = {}
+__hostBackoffTime = 5
+__hostMaxBackoffTime = 300
+__failingHosts = {}
+__hostLimits = {}
+__defaultTimeouts = {"Connect": 10, "Read": 30}
+__requestDeadline = threading.local()
+__hostLatencies = {}
+__latencySampleCount = 100
+__retryBackoffTime = 0.5
+__retryMaxBackoffTime = 4
 __headers     = {"User-agent" : "Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_5_6; en-us) AppleWebKit/530.1+ (KHTML, like Gecko) Version/3.2.1 Safari/525.27.1", "Accept-encoding" : "gzip"}
 __saveScheduled = False
 __autoUpdateCacheTime = 60
+__autoUpdateThreadCount = 2
+__autoUpdateIdleTime = 86400
+__autoUpdateQueue = None
+__updateSchedule = []
+
+####################################################################################################
+
+class __connectionPool(object):
+  #
+  # Idle persistent connections, kept per host so that requests to the same server can reuse an
+  # open connection instead of connecting (and negotiating SSL) every time
+  #
+  def __init__(self, size=4, idleTimeout=30):
+    self.size = size
+    self.idleTimeout = idleTimeout
+    self.connections = {}
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    self.lock.acquire()
+    try:
+      idle = self.connections.get(key, [])
+      while len(idle) > 0:
+        conn, releaseTime = idle.pop()
+        if time.time() - releaseTime < self.idleTimeout:
+          return conn
+        conn.close()
+      return None
+    finally:
+      self.lock.release()
+
+  def put(self, key, conn):
+    self.lock.acquire()
+    try:
+      idle = self.connections.setdefault(key, [])
+      if len(idle) < self.size:
+        idle.append((conn, time.time()))
+        return
+    finally:
+      self.lock.release()
+    conn.close()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      for idle in self.connections.values():
+        for conn, releaseTime in idle:
+          conn.close()
+      self.connections = {}
+    finally:
+      self.lock.release()
+
+####################################################################################################
+
+class __hostLimit(object):
+  #
+  # Limits the rate of requests sent to a host using a token bucket, and the number of requests in
+  # progress at once. Threads waiting to send a request are let through in the order they arrived.
+  #
+  def __init__(self, rate=None, concurrency=None):
+    self.rate = rate
+    self.concurrency = concurrency
+    self.tokens = 1
+    if rate:
+      self.tokens = max(rate, 1)
+    self.refillTime = time.time()
+    self.active = 0
+    self.waiting = []
+    self.condition = threading.Condition()
+
+  def refill(self):
+    now = time.time()
+    if self.rate:
+      self.tokens = min(max(self.rate, 1), self.tokens + (now - self.refillTime) * self.rate)
+    self.refillTime = now
+
+  def acquire(self, timeout=None):
+    # Returns False if the limits don't let the request through within the timeout
+    self.condition.acquire()
+    try:
+      endTime = None
+      if timeout is not None:
+        endTime = time.time() + timeout
+      ticket = object()
+      self.waiting.append(ticket)
+      while True:
+        wait = None
+        if self.waiting[0] is ticket and (not self.concurrency or self.active < self.concurrency):
+          self.refill()
+          if not self.rate or self.tokens >= 1:
+            if self.rate:
+              self.tokens -= 1
+            self.active += 1
+            self.waiting.pop(0)
+            self.condition.notifyAll()
+            return True
+          wait = (1 - self.tokens) / self.rate
+        if endTime is not None:
+          remaining = endTime - time.time()
+          if remaining <= 0:
+            self.waiting.remove(ticket)
+            self.condition.notifyAll()
+            return False
+          if wait is None or remaining < wait:
+            wait = remaining
+        self.condition.wait(wait)
+    finally:
+      self.condition.release()
+
+  def release(self):
+    self.condition.acquire()
+    try:
+      self.active -= 1
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+####################################################################################################
+
+class __pooledSocket(object):
+  #
+  # Feeds a response to urllib2's file object, handing the connection back to the pool once the
+  # whole response has been read
+  #
+  def __init__(self, pool, key, conn, response, limit=None):
+    self.pool = pool
+    self.key = key
+    self.conn = conn
+    self.response = response
+    self.limit = limit
+
+  def recv(self, amt):
+    data = self.response.read(amt)
+    if not data or self.response.isclosed() or self.response.length == 0:
+      self.release()
+    return data
+
+  def release(self):
+    if self.conn is None:
+      return
+    if self.response.will_close or not (self.response.isclosed() or self.response.length == 0):
+      # The connection can't be reused unless the server keeps it open & the response was consumed
+      self.conn.close()
+    else:
+      self.response.close()
+      self.pool.put(self.key, self.conn)
+    self.conn = None
+    if self.limit is not None:
+      self.limit.release()
+
+  def close(self):
+    self.release()
+
+####################################################################################################
+
+class __keepAliveOpener:
+  def keepalive_open(self, connectionClass, req):
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError("no host given")
+
+    headers = dict(req.headers)
+    headers.update(req.unredirected_hdrs)
+    headers = dict([(name.title(), value) for name, value in headers.items()])
+
+    # Requests made by the framework carry their own timeouts - others (e.g. redirects) use the defaults
+    connectTimeout = getattr(req, "connectTimeout", self.timeouts["Connect"])
+    readTimeout = getattr(req, "readTimeout", self.timeouts["Read"])
+
+    # Wait until the host's limits allow another request, giving up if the request's deadline passes
+    # first. The request counts as in progress until the response has been read.
+    limit = self.limits.get(host, self.limits.get(host.split(":")[0]))
+    deadline = getattr(req, "deadline", None)
+    if limit is not None:
+      if deadline is None:
+        limit.acquire()
+      else:
+        if not limit.acquire(deadline - time.time()):
+          raise urllib2.URLError("request deadline passed while waiting to request %s" % host)
+        
+        # Don't let the wait push the request past its deadline
+        remaining = max(deadline - time.time(), 0.001)
+        if connectTimeout is None or remaining < connectTimeout:
+          connectTimeout = remaining
+        if readTimeout is None or remaining < readTimeout:
+          readTimeout = remaining
+
+    # Until the pooled socket takes ownership of the connection, any error closes the connection &
+    # releases the host's limit
+    key = (connectionClass, host)
+    conn = None
+    try:
+      conn = self.pool.get(key)
+      while True:
+        reused = conn is not None
+        if not reused:
+          try:
+            conn = connectionClass(host, timeout=connectTimeout)
+          except TypeError:
+            # Connections can't be given a timeout before Python 2.6
+            conn = connectionClass(host)
+        try:
+          if conn.sock is None:
+            conn.connect()
+          conn.sock.settimeout(readTimeout)
+          conn.request(req.get_method(), req.get_selector(), req.data, headers)
+          response = conn.getresponse()
+          break
+        except (socket.error, httplib.HTTPException), e:
+          conn.close()
+          # The server may have dropped an idle connection, so retry once on a new one
+          if not reused or isinstance(e, socket.timeout):
+            raise urllib2.URLError(e)
+          conn = None
+      
+      # Redirects & error responses often aren't read to the end (urllib2 raises or follows them),
+      # so they give up their place within the host's limits as soon as they arrive
+      if limit is not None and response.status >= 300:
+        limit.release()
+        limit = None
+      sock = self.socketClass(self.pool, key, conn, response, limit)
+    except:
+      if conn is not None:
+        conn.close()
+      if limit is not None:
+        limit.release()
+      raise
+
+    fp = socket._fileobject(sock, close=True)
+    resp = urllib.addinfourl(fp, response.msg, req.get_full_url())
+    resp.code = response.status
+    resp.msg = response.reason
+    return resp
+
+class __keepAliveHTTPHandler(__keepAliveOpener, urllib2.HTTPHandler):
+  def __init__(self, pool, socketClass, limits, timeouts):
+    urllib2.HTTPHandler.__init__(self)
+    self.pool = pool
+    self.socketClass = socketClass
+    self.limits = limits
+    self.timeouts = timeouts
+
+  def http_open(self, req):
+    return self.keepalive_open(httplib.HTTPConnection, req)
+
+if hasattr(urllib2, "HTTPSHandler"):
+  class __keepAliveHTTPSHandler(__keepAliveOpener, urllib2.HTTPSHandler):
+    def __init__(self, pool, socketClass, limits, timeouts):
+      urllib2.HTTPSHandler.__init__(self)
+      self.pool = pool
+      self.socketClass = socketClass
+      self.limits = limits
+      self.timeouts = timeouts
+
+    def https_open(self, req):
+      return self.keepalive_open(httplib.HTTPSConnection, req)
+
+__pool = __connectionPool()
 
 ####################################################################################################
 
@@ -27,33 +310,201 @@ def __loadCookieJar():
   else:
     PMS.Log("(Framework) No cookie jar found")
 
-  # Build & install an opener with the cookie jar & auth handler
-  opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(__cookieJar), __authHandler)
+  # Build & install an opener with the cookie jar, auth handler & pooled connection handlers
+  handlers = [urllib2.HTTPCookieProcessor(__cookieJar), __authHandler, __keepAliveHTTPHandler(__pool, __pooledSocket, __hostLimits, __defaultTimeouts)]
+  if hasattr(urllib2, "HTTPSHandler"):
+    handlers.append(__keepAliveHTTPSHandler(__pool, __pooledSocket, __hostLimits, __defaultTimeouts))
+  opener = urllib2.build_opener(*handlers)
   urllib2.install_opener(opener)
 
 ####################################################################################################  
   
+def __cachePath(url=None):
+  # The cache is stored as an index of the cached pages, plus a file for each page's content
+  if url is None:
+    return "%s/HTTPCache" % Data.__dataPath
+  return "%s/HTTPCache/%s" % (Data.__dataPath, Hash.MD5(url))
+
+####################################################################################################  
+  
 def __loadCache():
   global __cache
-  path = "%s/HTTPCache" % Data.__dataPath
-  if os.path.exists(path):
+  global __cacheMemoryUsed
+  path = __cachePath()
+  if os.path.isfile(path):
+    # Move pages from the old single-file cache into the new store
     try:
       __cache = Data.__unpickle(path)
+      os.unlink(path)
+      __changedEntries.update(__cache.keys())
+      __cacheMemoryUsed = sum([len(item["Content"]) for item in __cache.values()])
+      PMS.Log("(Framework) Converted the HTTP cache")
+      __save()
+    except:
+      __cache = {}
+      __changedEntries.clear()
+      PMS.Log("(Framework) An error occurred when converting the HTTP cache")
+      # Remove the unreadable file so the new cache directory can be created in its place
+      try:
+        if os.path.isfile(path):
+          os.unlink(path)
+      except:
+        PMS.Log("(Framework) Couldn't remove the old HTTP cache")
+  elif os.path.exists("%s/Index" % path):
+    # Only the index is loaded - page content is read from disk when first requested
+    try:
+      __cache = Data.__unpickle("%s/Index" % path)
       PMS.Log("(Framework) Loaded HTTP cache")
     except:
       __cache = {}
       PMS.Log("(Framework) An error occurred when loading the HTTP cache")
+  
+  # Schedule updates of automatically updated pages
+  for url in __cache:
+    item = __cache[url]
+    if not item.has_key("AccessTime"):
+      item["AccessTime"] = time.time()
+    if item.has_key("UpdateTime"):
+      __scheduleUpdate(url, item)
+
+####################################################################################################
+
+def __content(url, item, touch=True):
+  # Returns the content of a cached page, loading it from disk if it isn't in memory
+  global __cacheMemoryUsed
+  if touch:
+    item["AccessTime"] = time.time()
+  content = item.get("Content")
+  if content is not None:
+    return __decompressedContent(url, item, content)
+  try:
+    if item.has_key("SharedHash"):
+      content = __sharedContent(item["SharedHash"])
+    else:
+      f = open(__cachePath(url), "rb")
+      content = f.read()
+      f.close()
+  except:
+    content = None
+  if content is None:
+    PMS.Log("(Framework) Couldn't load the cached copy of %s" % url)
+    return None
+  Thread.Lock("Framework.HTTPCache", addToLog=False)
+  try:
+    if __cache.get(url) is item and not item.has_key("Content"):
+      item["Content"] = content
+      __cacheMemoryUsed += len(content)
+      __trimCache()
+  finally:
+    Thread.Unlock("Framework.HTTPCache", addToLog=False)
+  return __decompressedContent(url, item, content)
+
+####################################################################################################
+
+def __compressedContent(content):
+  # Returns the content to store in the cache, & whether it was compressed
+  if __compressCache:
+    compressed = zlib.compress(content)
+    if len(compressed) < len(content):
+      return compressed, True
+  return content, False
+
+####################################################################################################
+
+def __decompressedContent(url, item, content):
+  #
+  # Returns the page content for a cached item. Compressed content is decompressed, and the result
+  # kept in a small set of recently used pages so that popular pages aren't decompressed every time.
+  #
+  global __hotContentUsed
+  if not item.get("Compressed"):
+    return content
+  Thread.Lock("Framework.HTTPHotContent", addToLog=False)
+  try:
+    if __hotContent.has_key(url) and __hotContent[url]["Item"] is item:
+      __hotContent[url]["AccessTime"] = time.time()
+      return __hotContent[url]["Content"]
+  finally:
+    Thread.Unlock("Framework.HTTPHotContent", addToLog=False)
+  
+  content = zlib.decompress(content)
+  Thread.Lock("Framework.HTTPHotContent", addToLog=False)
+  try:
+    if __hotContent.has_key(url):
+      __hotContentUsed -= len(__hotContent[url]["Content"])
+    __hotContent[url] = {"Item": item, "Content": content, "AccessTime": time.time()}
+    __hotContentUsed += len(content)
+    if __hotContentUsed > __hotContentSize:
+      urls = __hotContent.keys()
+      urls.sort(key=lambda url: __hotContent[url]["AccessTime"])
+      for oldURL in urls:
+        if __hotContentUsed <= __hotContentSize:
+          break
+        __hotContentUsed -= len(__hotContent[oldURL]["Content"])
+        del __hotContent[oldURL]
+  finally:
+    Thread.Unlock("Framework.HTTPHotContent", addToLog=False)
+  return content
+
+####################################################################################################
+
+def __trimCache():
+  #
+  # Drop the content of the least recently used pages from memory until the cache fits within its
+  # size limit. Pages that are updated automatically or haven't been written to disk yet are kept.
+  #
+  global __cacheMemoryUsed
+  if __cacheMemoryUsed <= __cacheSize:
+    return
+  candidates = []
+  for url in __cache:
+    item = __cache[url]
+    if item.has_key("Content") and not item.has_key("UpdateTime") and (url not in __changedEntries or item.has_key("SharedHash")):
+      candidates.append((item.get("AccessTime", 0), url))
+  candidates.sort()
+  for accessTime, url in candidates:
+    if __cacheMemoryUsed <= __cacheSize:
+      break
+    __cacheMemoryUsed -= len(__cache[url]["Content"])
+    del __cache[url]["Content"]
+
+####################################################################################################
 
 def __save():
   global __saveScheduled
   Thread.Lock("Framework.HTTPCache", addToLog=False)
   try:
-    # Save the cache
-    Data.__pickle("%s/HTTPCache" % Data.__dataPath, __cache)
+    path = __cachePath()
+    if not os.path.exists(path):
+      os.makedirs(path)
+
+    # Write the content of pages that changed since the last save
+    for url in __changedEntries:
+      if __cache.has_key(url) and __cache[url].has_key("Content") and not __cache[url].has_key("SharedHash"):
+        f = open(__cachePath(url), "wb")
+        f.write(__cache[url]["Content"])
+        f.close()
+    __changedEntries.clear()
+    __trimCache()
+
+    # Save the index
+    index = {}
+    for url in __cache:
+      item = __cache[url].copy()
+      if item.has_key("Content"):
+        del item["Content"]
+      index[url] = item
+    Data.__pickle("%s/Index.tmp" % path, index)
+    if os.path.exists("%s/Index" % path):
+      os.unlink("%s/Index" % path)
+    os.rename("%s/Index.tmp" % path, "%s/Index" % path)
     
     # Save the cookie jar
     if __cookieJar is not None:
       __cookieJar.save("%s/HTTPCookies" % Data.__dataPath)
+    
+    if __sharedCache:
+      __sharedCleanup()
 
   finally:
     __saveScheduled = False
@@ -75,6 +526,131 @@ def SetCacheTime(cacheTime):
 
 ####################################################################################################
 
+def SetCacheSize(size):
+  # Set the number of bytes of cached page content to keep in memory
+  global __cacheSize
+  Thread.Lock("Framework.HTTPCache", addToLog=False)
+  try:
+    __cacheSize = size
+    __trimCache()
+  finally:
+    Thread.Unlock("Framework.HTTPCache", addToLog=False)
+
+####################################################################################################
+
+def SetFailureCacheTimes(clientErrors=60, serverErrors=10, connectionErrors=10):
+  # Set how many seconds a failed request is remembered for, so it isn't retried straight away
+  __failureCacheTimes["ClientError"] = clientErrors
+  __failureCacheTimes["ServerError"] = serverErrors
+  __failureCacheTimes["ConnectionError"] = connectionErrors
+
+####################################################################################################
+
+def SetHostBackoff(initial=5, maximum=300):
+  #
+  # Set how many seconds to stop sending requests to a host for after it fails to respond or
+  # returns a server error. The time doubles with each consecutive failure, up to the maximum.
+  #
+  global __hostBackoffTime
+  global __hostMaxBackoffTime
+  __hostBackoffTime = initial
+  __hostMaxBackoffTime = maximum
+
+####################################################################################################
+
+def SetHostLimits(host, rps=None, concurrency=None):
+  #
+  # Limit the requests sent to the given host to rps requests per second, with at most concurrency
+  # requests in progress at once. Pass None to remove a limit.
+  #
+  if rps is None and concurrency is None:
+    if __hostLimits.has_key(host):
+      del __hostLimits[host]
+  else:
+    __hostLimits[host] = __hostLimit(rps, concurrency)
+
+####################################################################################################
+
+def SetTimeout(connectTimeout=10, readTimeout=30):
+  # Set the default number of seconds to wait for a connection to a server, and for data to arrive
+  __defaultTimeouts["Connect"] = connectTimeout
+  __defaultTimeouts["Read"] = readTimeout
+
+####################################################################################################
+
+def __setDeadline(deadline):
+  # Set the time by which requests made on the current thread should give up
+  __requestDeadline.time = deadline
+
+####################################################################################################
+
+def __deadline():
+  return getattr(__requestDeadline, "time", None)
+
+####################################################################################################
+
+def __remainingTime():
+  deadline = __deadline()
+  if deadline is None:
+    return None
+  return deadline - time.time()
+
+####################################################################################################
+
+def __deadlinePassed():
+  remaining = __remainingTime()
+  return remaining is not None and remaining <= 0
+
+####################################################################################################
+
+def __requestTimeouts(timeout=None):
+  #
+  # Returns the connect & read timeouts for a request, cut short if the deadline is near, and
+  # whether the deadline cut them short
+  #
+  timeouts = [__defaultTimeouts["Connect"], __defaultTimeouts["Read"]]
+  remaining = __remainingTime()
+  shortened = False
+  for i in range(len(timeouts)):
+    for limit in [timeout, remaining]:
+      if limit is not None and (timeouts[i] is None or limit < timeouts[i]):
+        timeouts[i] = max(limit, 0.001)
+        shortened = shortened or limit is remaining
+  return (timeouts[0], timeouts[1], shortened)
+
+####################################################################################################
+
+def SetCacheCompression(enabled=True, hotSize=1048576):
+  #
+  # Store newly cached pages compressed, both in memory & on disk. Up to hotSize bytes of recently
+  # used pages are also kept uncompressed.
+  #
+  global __compressCache
+  global __hotContentSize
+  __compressCache = enabled
+  __hotContentSize = hotSize
+
+####################################################################################################
+
+def SetSharedCache(enabled=True):
+  #
+  # Share cached pages with other plug-ins that enable the shared cache. Pages are kept in a
+  # database in the Framework Support directory, with identical content only stored once.
+  #
+  global __sharedCache
+  __sharedCache = enabled
+
+####################################################################################################
+
+def SetConnectionPool(size=4, idleTimeout=30):
+  # Set the number of idle connections kept open per host, and how many seconds they're kept for
+  __pool.size = size
+  __pool.idleTimeout = idleTimeout
+  if size == 0:
+    __pool.clear()
+
+####################################################################################################
+
 def SetPassword(url, username, password, realm=None):
   global __passMgr
   # Strip http:// from the beginning of the url
@@ -99,9 +675,155 @@ def PreCache(url, values=None, headers={}, cacheTime=None, autoUpdate=False, enc
 
 ####################################################################################################
 
-def Request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None, addToLog=True):
+def Request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None, addToLog=True, staleTime=0, timeout=None, hedgeAfter=None, retries=0):
+  #
+  # If staleTime is given, a cached copy that expired less than staleTime seconds ago is returned
+  # straight away, and updated in the background. If timeout is given, it overrides the default
+  # connect & read timeouts.
+  #
+  # GET requests can also be hedged & retried. If hedgeAfter is given, a second request is sent
+  # if the first takes longer than that percentile (e.g. 95) of the host's recent response times,
+  # and whichever answers first is used. Requests that fail with a connection or server error are
+  # retried up to the given number of times, waiting longer after each attempt.
+  #
+  return __request(url, values, headers, cacheTime, autoUpdate, encoding, errors, addToLog, staleTime=staleTime, timeout=timeout, hedgeAfter=hedgeAfter, retries=retries)
+
+####################################################################################################
+
+def RequestMany(urls, maxConcurrency=4, headers={}, cacheTime=None, encoding=None, errors=None, inOrder=True, addToLog=True):
+  #
+  # Fetch several pages at once using a fixed number of threads. By default, returns a list with
+  # the content of each page in the same order as the URLs. If inOrder is False, returns an iterator
+  # yielding (url, content) tuples as each page arrives. Pages that can't be fetched return None.
+  #
+  urls = list(urls)
+  pending = Queue.Queue()
+  results = Queue.Queue()
+  for i in range(len(urls)):
+    pending.put((i, urls[i]))
+  for i in range(min(maxConcurrency, len(urls))):
+    Thread.__createDaemon(__requestManyWorker, pending, results, headers, cacheTime, encoding, errors, addToLog, __deadline())
+
+  if inOrder:
+    content = [None] * len(urls)
+    for i in range(len(urls)):
+      index, url, result = results.get()
+      content[index] = result
+    return content
+  else:
+    return __requestManyResults(results, len(urls))
+
+####################################################################################################
+
+def __requestManyResults(results, count):
+  for i in range(count):
+    index, url, result = results.get()
+    yield (url, result)
+
+####################################################################################################
+
+def __requestManyWorker(pending, results, headers, cacheTime, encoding, errors, addToLog, deadline):
+  # Workers share the deadline of the thread that started them
+  __setDeadline(deadline)
+  while True:
+    try:
+      index, url = pending.get_nowait()
+    except Queue.Empty:
+      return
+    try:
+      result = Request(url, headers=headers, cacheTime=cacheTime, encoding=encoding, errors=errors, addToLog=addToLog)
+    except:
+      PMS.Log("(Framework) Exception when requesting '%s'" % url)
+      result = None
+    results.put((index, url, result))
+
+####################################################################################################
+
+def Stream(url, values=None, headers={}, chunkSize=65536, addToLog=True):
+  #
+  # Returns an iterator over the content of the page, decompressed as it arrives, without keeping
+  # the whole response in memory. Nothing is cached. Returns None if the page can't be fetched.
+  #
+  try:
+    data = None
+    if values is not None: data = urllib.urlencode(values)
+    h = __headers.copy()
+    for header in headers:
+      h[header] = headers[header]
+    request = urllib2.Request(url, data, h)
+    request.connectTimeout, request.readTimeout, shortened = __requestTimeouts()
+    request.deadline = __deadline()
+    f = urllib2.urlopen(request)
+  except urllib2.HTTPError, e:
+    e.close()
+    PMS.Log("(Framework) HTTPError when requesting '%s'" % url)
+    return None
+  except urllib2.URLError:
+    PMS.Log("(Framework) URLError when requesting '%s'" % url)
+    return None
+  if addToLog: PMS.Log("(Framework) Streaming response from %s" % url)
+  return __streamChunks(f, chunkSize)
+
+####################################################################################################
+
+def __streamChunks(f, chunkSize):
+  contentEncoding = f.headers.get("Content-Encoding")
+  decompressor = None
+  if contentEncoding == "gzip":
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+  elif contentEncoding == "deflate":
+    decompressor = zlib.decompressobj()
+  try:
+    started = False
+    while True:
+      chunk = f.read(chunkSize)
+      if not chunk:
+        break
+      if decompressor is not None:
+        try:
+          chunk = decompressor.decompress(chunk)
+        except zlib.error:
+          # Some servers send raw deflate data without the zlib header
+          if started or contentEncoding != "deflate":
+            raise
+          decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+          chunk = decompressor.decompress(chunk)
+      started = True
+      if chunk:
+        yield chunk
+    if decompressor is not None:
+      chunk = decompressor.flush()
+      if chunk:
+        yield chunk
+  finally:
+    f.close()
+
+####################################################################################################
+
+def Download(url, path, values=None, headers={}, addToLog=True):
+  # Save the page to the given path as it arrives. Returns True if the download completed.
+  chunks = Stream(url, values, headers, addToLog=addToLog)
+  if chunks is None:
+    return False
+  try:
+    f = open(path, "wb")
+    try:
+      for chunk in chunks:
+        f.write(chunk)
+    finally:
+      f.close()
+  except:
+    PMS.Log("(Framework) Couldn't download %s to %s" % (url, path))
+    if os.path.exists(path):
+      os.unlink(path)
+    return False
+  if addToLog: PMS.Log("(Framework) Downloaded %s to %s" % (url, path))
+  return True
+
+####################################################################################################
+
+def __request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None, addToLog=True, revalidate=False, staleTime=0, timeout=None, hedgeAfter=None, retries=0):
   global __cache
-  global __saveScheduled
   now = Datetime.Now()
   
   # If no cache time is given, use the default
@@ -109,18 +831,126 @@ def Request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, enco
     cacheTime = __cacheTime
   
   # Attempt to return a cached copy, fetching again if an exception occurs
+  cachedItem = None
   try:
     # Make sure we don't cache POST requests
     if values == None and cacheTime > 0:
       if __cache.has_key(url):
-        cachedAt = __cache[url]["CheckTime"]
-        expiresAt = cachedAt + Datetime.Delta(seconds=cacheTime)
-        if Datetime.Now() < expiresAt:
-          if addToLog: PMS.Log("(Framework) Loaded %s from the cache (expires at %s)" % (url, expiresAt))
-          return __cache[url]["Content"]
+        cachedItem = __cache[url]
+        content = __content(url, cachedItem, touch=not revalidate)
+        if content is None:
+          cachedItem = None
+        else:
+          cachedAt = cachedItem["CheckTime"]
+          expiresAt = cachedAt + Datetime.Delta(seconds=cacheTime)
+          if Datetime.Now() < expiresAt and not revalidate:
+            if addToLog: PMS.Log("(Framework) Loaded %s from the cache (expires at %s)" % (url, expiresAt))
+            return content
+          if Datetime.Now() < expiresAt + Datetime.Delta(seconds=staleTime) and not revalidate:
+            if addToLog: PMS.Log("(Framework) Loaded %s from the cache (expired at %s, updating in the background)" % (url, expiresAt))
+            __refreshInBackground(url, headers, cacheTime, autoUpdate, encoding, errors)
+            return content
   except:
     if addToLog: PMS.Log("(Framework) Couldn't load %s from the cache, attempting to fetch again.")
-    
+  
+  # Don't contact a server that failed recently - return the cached copy instead if there is one
+  if __isFailing(url, values is None):
+    if addToLog: PMS.Log("(Framework) Not requesting %s due to a recent failure" % url)
+    return __staleContent(url, cachedItem, addToLog)
+  
+  # Give up straight away if the deadline for handling the current request has passed
+  remaining = __remainingTime()
+  if __deadlinePassed():
+    PMS.Log("(Framework) Not requesting %s as the request deadline has passed" % url)
+    return __staleContent(url, cachedItem, addToLog)
+  
+  # POST requests are always sent to the server
+  if values is not None:
+    return __fetch(url, values, headers, cacheTime, autoUpdate, encoding, errors, addToLog, cachedItem, revalidate, timeout)
+  
+  # If another thread is already fetching the same page, wait for its result instead of sending
+  # the request again
+  key = __requestKey(url, headers, encoding, errors)
+  Thread.Lock("Framework.HTTPRequests", addToLog=False)
+  try:
+    inProgress = __requestsInProgress.get(key)
+    if inProgress is None:
+      inProgress = {"Event": threading.Event(), "Result": None}
+      __requestsInProgress[key] = inProgress
+      isFetching = True
+    else:
+      isFetching = False
+  finally:
+    Thread.Unlock("Framework.HTTPRequests", addToLog=False)
+  
+  if not isFetching:
+    if addToLog: PMS.Log("(Framework) Waiting for a request for %s that's already in progress" % url)
+    inProgress["Event"].wait(remaining)
+    if not inProgress["Event"].isSet():
+      PMS.Log("(Framework) Request deadline passed while waiting for %s" % url)
+      return __staleContent(url, cachedItem, addToLog)
+    return inProgress["Result"]
+  
+  try:
+    inProgress["Result"] = __fetch(url, values, headers, cacheTime, autoUpdate, encoding, errors, addToLog, cachedItem, revalidate, timeout, hedgeAfter, retries)
+  finally:
+    Thread.Lock("Framework.HTTPRequests", addToLog=False)
+    del __requestsInProgress[key]
+    Thread.Unlock("Framework.HTTPRequests", addToLog=False)
+    inProgress["Event"].set()
+  return inProgress["Result"]
+
+####################################################################################################
+
+def __requestKey(url, headers, encoding, errors):
+  return (url, tuple(sorted(headers.items())), encoding, errors)
+
+####################################################################################################
+
+def __refreshInBackground(url, headers, cacheTime, autoUpdate, encoding, errors):
+  # Start updating a cached page on another thread, unless it's already being updated
+  key = __requestKey(url, headers, encoding, errors)
+  Thread.Lock("Framework.HTTPRequests", addToLog=False)
+  try:
+    if key in __refreshesInProgress:
+      return
+    __refreshesInProgress.add(key)
+  finally:
+    Thread.Unlock("Framework.HTTPRequests", addToLog=False)
+  Thread.__createDaemon(__backgroundRefresh, key, url, headers, cacheTime, autoUpdate, encoding, errors)
+
+####################################################################################################
+
+def __backgroundRefresh(key, url, headers, cacheTime, autoUpdate, encoding, errors):
+  try:
+    try:
+      __request(url, headers=headers, cacheTime=cacheTime, autoUpdate=autoUpdate, encoding=encoding, errors=errors, addToLog=False, revalidate=True)
+    except:
+      PMS.Log("(Framework) Exception when updating the cached copy of %s" % url)
+  finally:
+    Thread.Lock("Framework.HTTPRequests", addToLog=False)
+    __refreshesInProgress.discard(key)
+    Thread.Unlock("Framework.HTTPRequests", addToLog=False)
+
+####################################################################################################
+
+def __fetch(url, values, headers, cacheTime, autoUpdate, encoding, errors, addToLog, cachedItem, revalidate=False, timeout=None, hedgeAfter=None, retries=0):
+  # Use the copy in the shared cache if another plug-in fetched the page recently enough
+  sharedKey = None
+  if __sharedCache and values is None and cacheTime > 0 and __sharedCacheable(url, headers):
+    sharedKey = __sharedKey(url, encoding, errors)
+    item = __sharedItem(sharedKey, cacheTime)
+    if item is not None:
+      if addToLog: PMS.Log("(Framework) Loaded %s from the shared cache" % url)
+      if revalidate and cachedItem is not None:
+        item["AccessTime"] = cachedItem["AccessTime"]
+      content = __decompressedContent(url, item, item["Content"])
+      __cacheItem(url, item, cacheTime, autoUpdate, headers, encoding, errors)
+      return content
+  
+  # Requests whose timeouts were cut short by the deadline
+  cutShort = []
+  
   # Try to fetch the page from the server
   try:
     # Encode the values
@@ -129,9 +959,24 @@ def Request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, enco
     h = __headers.copy()
     for header in headers:
       h[header] = headers[header]
-    request = urllib2.Request(url, data, h)
-    f = urllib2.urlopen(request)
-    response = f.read()
+      
+    # If a cached copy has expired, ask the server to only send the page if it has changed since
+    if cachedItem is not None:
+      if cachedItem.get("ETag") is not None:
+        h["If-None-Match"] = cachedItem["ETag"]
+      if cachedItem.get("LastModified") is not None:
+        h["If-Modified-Since"] = cachedItem["LastModified"]
+    def createRequest():
+      request = urllib2.Request(url, data, h)
+      request.connectTimeout, request.readTimeout, shortened = __requestTimeouts(timeout)
+      request.deadline = __deadline()
+      if shortened:
+        cutShort.append(request)
+      return request
+    if values is None:
+      f, response = __retriedAttempts(createRequest, hedgeAfter, retries)
+    else:
+      f, response = __attempt(createRequest())
     
     # If the response is gzipped, unzip it
     if f.headers.get('Content-Encoding') == "gzip":
@@ -152,53 +997,470 @@ def Request(url, values=None, headers={}, cacheTime=None, autoUpdate=False, enco
       if addToLog: PMS.Log("(Framework) Unable to decode response from '%s' with codec %s" % (url, encoding))
 
   # Handle common errors
-  except urllib2.HTTPError:
+  except urllib2.HTTPError, e:
+    if e.code == 304 and cachedItem is not None:
+      e.close()
+      __recordSuccess(url)
+      return __revalidated(url, cachedItem, cacheTime, addToLog, touch=not revalidate)
+    e.close()
     PMS.Log("(Framework) HTTPError when requesting '%s'" % url)
-    return None
+    __recordFailure(url, values is None, e.code, e.hdrs.get("Retry-After"))
+    return __staleContent(url, cachedItem, addToLog)
   except urllib2.URLError:
     PMS.Log("(Framework) URLError when requesting '%s'" % url)
-    return None
+    # Running out of time for the request isn't a problem with the host
+    if not (cutShort or __deadlinePassed()):
+      __recordFailure(url, values is None)
+    return __staleContent(url, cachedItem, addToLog)
+  except (socket.error, httplib.HTTPException):
+    # Timed out or lost the connection while reading the response
+    PMS.Log("(Framework) Error when reading the response from '%s'" % url)
+    if not (cutShort or __deadlinePassed()):
+      __recordFailure(url, values is None)
+    return __staleContent(url, cachedItem, addToLog)
+  
+  __recordSuccess(url)
+  
+  # Cache the data if required
+  if response is not None and cacheTime > 0:
+    item = {}
+    item["Content"], item["Compressed"] = __compressedContent(response)
+    item["CheckTime"] = Datetime.Now()
+    item["AccessTime"] = time.time()
+    if revalidate and cachedItem is not None:
+      # Automatic updates don't count as the page being used
+      item["AccessTime"] = cachedItem["AccessTime"]
+    item["ETag"] = f.headers.get("ETag")
+    item["LastModified"] = f.headers.get("Last-Modified")
+    if sharedKey is not None:
+      __sharedStore(sharedKey, item, Hash.SHA1(response))
+    __cacheItem(url, item, cacheTime, autoUpdate, headers, encoding, errors)
+    if addToLog: PMS.Log("(Framework) Cached response from %s" % url)
+  else:
+    __scheduleSave()
+      
+  # Return the data
+  return response
+
+####################################################################################################
 
+def __cacheItem(url, item, cacheTime, autoUpdate, headers, encoding, errors):
+  global __cacheMemoryUsed
+  Thread.Lock("Framework.HTTPCache", addToLog=False)
+  try:
+    if autoUpdate:
+      item["UpdateTime"] = Datetime.Now() + Datetime.Delta(seconds=cacheTime)
+      item["CacheTime"] = cacheTime
+      item["Headers"] = headers
+      item["Encoding"] = encoding
+      item["Errors"] = errors
+      __scheduleUpdate(url, item)
+    if __cache.has_key(url) and __cache[url].has_key("Content"):
+      __cacheMemoryUsed -= len(__cache[url]["Content"])
+    __cache[url] = item
+    __cacheMemoryUsed += len(item["Content"])
+    __changedEntries.add(url)
+    __trimCache()
+  finally:
+    Thread.Unlock("Framework.HTTPCache", addToLog=False)
+  __scheduleSave()
+
+####################################################################################################
+
+def __scheduleSave():
+  global __saveScheduled
   Thread.Lock("Framework.HTTPCache", addToLog=False)
   try:
-    # Cache the data if required
-    if response is not None and cacheTime > 0:
-      item = {}
-      item["Content"] = response
-      item["CheckTime"] = Datetime.Now()
-      if autoUpdate:
-        item["UpdateTime"] = Datetime.Now() + Datetime.Delta(seconds=cacheTime)
-        item["CacheTime"] = cacheTime
-        item["Headers"] = headers
-        item["Encoding"] = encoding
-        item["Errors"] = errors
-      __cache[url] = item
-      if addToLog: PMS.Log("(Framework) Cached response from %s" % url)
-      
-    
     if not __saveScheduled:
       Thread.CreateTimer(5, __save)
       __saveScheduled = True
   finally:
     Thread.Unlock("Framework.HTTPCache", addToLog=False)
-      
-  # Return the data
-  return response
 
 ####################################################################################################
 
-def __autoUpdateCachedPages():
-  global __cache
-  for url in __cache:
-    item = __cache[url]
+def __sharedDB():
+  #
+  # Returns this thread's connection to the shared cache database. SQLite handles locking between
+  # plug-in processes; write-ahead logging lets them read while another process is writing.
+  #
+  db = getattr(__sharedConnections, "db", None)
+  if db is None:
+    import sqlite3
+    db = sqlite3.connect(os.path.join(Plugin.__frameworkSupportFilesPath, "HTTPCache.db"), timeout=30)
+    try:
+      db.execute("PRAGMA journal_mode=WAL")
+      db.execute("PRAGMA synchronous=NORMAL")
+    except:
+      pass
+    db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, hash TEXT, check_time REAL, etag TEXT, last_modified TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS contents (hash TEXT PRIMARY KEY, compressed INTEGER, content BLOB)")
+    db.commit()
+    __sharedConnections.db = db
+  return db
+
+####################################################################################################
+
+def __sharedCacheable(url, headers):
+  #
+  # Pages requested with the caller's own headers, or with this plug-in's cookies or credentials for
+  # the site, may differ from what other plug-ins get for the same URL, so aren't shared
+  #
+  if headers:
+    return False
+  if GetCookiesForURL(url) is not None:
+    return False
+  for realm in __passMgr.passwd.keys():
+    if __passMgr.find_user_password(realm, url)[0] is not None:
+      return False
+  return True
+
+####################################################################################################
+
+def __sharedKey(url, encoding, errors):
+  # Pages decoded with a specific codec are stored separately from the raw page
+  if encoding is None and errors is None:
+    return url
+  return "%s\n%s\n%s" % (url, encoding, errors)
+
+####################################################################################################
+
+def __sharedItem(key, cacheTime):
+  # Returns a new cache item for the page if the shared cache has a copy within the cache time
+  try:
+    db = __sharedDB()
+    row = db.execute("SELECT pages.hash, pages.check_time, pages.etag, pages.last_modified, contents.compressed, contents.content FROM pages JOIN contents ON pages.hash = contents.hash WHERE pages.key = ?", (key,)).fetchone()
+  except:
+    PMS.Log("(Framework) Couldn't read from the shared HTTP cache")
+    return None
+  if row is None:
+    return None
+  contentHash, checkTime, etag, lastModified, compressed, content = row
+  age = time.time() - checkTime
+  if age >= cacheTime:
+    return None
+  item = {}
+  item["Content"] = str(content)
+  item["Compressed"] = bool(compressed)
+  item["CheckTime"] = Datetime.Now() - Datetime.Delta(seconds=age)
+  item["AccessTime"] = time.time()
+  item["ETag"] = etag
+  item["LastModified"] = lastModified
+  item["SharedKey"] = key
+  item["SharedHash"] = contentHash
+  return item
+
+####################################################################################################
+
+def __sharedStore(key, item, contentHash):
+  # Store a newly fetched page in the shared cache, marking the item as stored there if successful
+  try:
+    import sqlite3
+    db = __sharedDB()
+    try:
+      db.execute("INSERT OR IGNORE INTO contents (hash, compressed, content) VALUES (?, ?, ?)", (contentHash, int(item["Compressed"]), sqlite3.Binary(item["Content"])))
+      db.execute("INSERT OR REPLACE INTO pages (key, hash, check_time, etag, last_modified) VALUES (?, ?, ?, ?, ?)", (key, contentHash, time.time(), item["ETag"], item["LastModified"]))
+      db.commit()
+    except:
+      db.rollback()
+      raise
+  except:
+    PMS.Log("(Framework) Couldn't write to the shared HTTP cache")
+    return
+  
+  # Content that was already stored by another plug-in may have been stored differently
+  row = db.execute("SELECT compressed FROM contents WHERE hash = ?", (contentHash,)).fetchone()
+  if row is not None and bool(row[0]) == item["Compressed"]:
+    item["SharedKey"] = key
+    item["SharedHash"] = contentHash
+
+####################################################################################################
+
+def __sharedContent(contentHash):
+  db = __sharedDB()
+  row = db.execute("SELECT content FROM contents WHERE hash = ?", (contentHash,)).fetchone()
+  if row is None:
+    return None
+  return str(row[0])
+
+####################################################################################################
+
+def __sharedRevalidated(key):
+  try:
+    db = __sharedDB()
+    db.execute("UPDATE pages SET check_time = ? WHERE key = ?", (time.time(), key))
+    db.commit()
+  except:
+    PMS.Log("(Framework) Couldn't write to the shared HTTP cache")
+
+####################################################################################################
+
+def __sharedCleanup():
+  # Remove pages that haven't been checked for a while, & content no page refers to
+  global __sharedCleanupTime
+  if time.time() - __sharedCleanupTime < 3600:
+    return
+  __sharedCleanupTime = time.time()
+  try:
+    db = __sharedDB()
+    db.execute("DELETE FROM pages WHERE check_time < ?", (time.time() - __sharedCacheMaxAge,))
+    db.execute("DELETE FROM contents WHERE hash NOT IN (SELECT hash FROM pages)")
+    db.commit()
+  except:
+    PMS.Log("(Framework) Couldn't clean up the shared HTTP cache")
+
+####################################################################################################
+
+def __attempt(request):
+  # Send the request & read the response, recording how long the host took to respond
+  startTime = time.time()
+  f = urllib2.urlopen(request)
+  response = f.read()
+  host = request.get_host()
+  Thread.Lock("Framework.HTTPLatency", addToLog=False)
+  try:
+    if not __hostLatencies.has_key(host):
+      __hostLatencies[host] = []
+    samples = __hostLatencies[host]
+    samples.append(time.time() - startTime)
+    if len(samples) > __latencySampleCount:
+      samples.pop(0)
+  finally:
+    Thread.Unlock("Framework.HTTPLatency", addToLog=False)
+  return f, response
+
+####################################################################################################
+
+def __hedgeDelay(host, percentile):
+  # Returns the given percentile of the host's recent response times, if enough are known
+  Thread.Lock("Framework.HTTPLatency", addToLog=False)
+  try:
+    samples = list(__hostLatencies.get(host, []))
+  finally:
+    Thread.Unlock("Framework.HTTPLatency", addToLog=False)
+  if len(samples) < 10:
+    return None
+  samples.sort()
+  return samples[min(int(len(samples) * percentile / 100.0), len(samples) - 1)]
+
+####################################################################################################
+
+def __attemptInThread(request, results):
+  try:
+    results.put((__attempt(request), None))
+  except:
+    results.put((None, sys.exc_info()))
+
+####################################################################################################
+
+def __hedgedAttempt(createRequest, hedgeAfter):
+  #
+  # Send the request, and send it again if there's no response by the time most responses from
+  # the host have arrived. The first successful response is returned.
+  #
+  request = createRequest()
+  delay = None
+  if hedgeAfter is not None:
+    delay = __hedgeDelay(request.get_host(), hedgeAfter)
+  if delay is None:
+    return __attempt(request)
+
+  results = Queue.Queue()
+  Thread.__createDaemon(__attemptInThread, request, results)
+  try:
+    result, error = results.get(True, delay)
+    attempts = 1
+  except Queue.Empty:
+    PMS.Log("(Framework) No response from %s after %.3f seconds, sending the request again" % (request.get_full_url(), delay))
+    Thread.__createDaemon(__attemptInThread, createRequest(), results)
+    result, error = results.get()
+    attempts = 2
+  if error is not None and attempts == 2:
+    if isinstance(error[1], urllib2.HTTPError):
+      error[1].close()
+    result, error = results.get()
+  if error is not None:
+    raise error[0], error[1], error[2]
+  return result
+
+####################################################################################################
+
+def __retriedAttempts(createRequest, hedgeAfter=None, retries=0):
+  # Retry requests that fail with a connection or server error, with an increasing delay
+  attempt = 0
+  while True:
+    try:
+      return __hedgedAttempt(createRequest, hedgeAfter)
+    except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+      if isinstance(e, urllib2.HTTPError) and e.code < 500 and e.code != 429:
+        raise
+      delay = min(__retryBackoffTime * (2 ** attempt), __retryMaxBackoffTime)
+      remaining = __remainingTime()
+      if attempt >= retries or (remaining is not None and remaining <= delay):
+        raise
+      attempt += 1
+      if isinstance(e, urllib2.HTTPError):
+        e.close()
+      PMS.Log("(Framework) Request failed, retrying in %s seconds (attempt %d of %d)" % (delay, attempt, retries))
+      time.sleep(delay)
+
+####################################################################################################
+
+def __isFailing(url, checkURL=True):
+  Thread.Lock("Framework.HTTPFailures", addToLog=False)
+  try:
+    now = time.time()
+    host = urlparse.urlparse(url)[1]
+    if __failingHosts.has_key(host) and __failingHosts[host]["RetryTime"] > now:
+      return True
+    if checkURL and __failedURLs.has_key(url):
+      if __failedURLs[url] > now:
+        return True
+      del __failedURLs[url]
+    return False
+  finally:
+    Thread.Unlock("Framework.HTTPFailures", addToLog=False)
+
+####################################################################################################
+
+def __recordFailure(url, cacheURL=True, code=None, retryAfter=None):
+  #
+  # Remember failed URLs for a time depending on the type of failure. Hosts that couldn't be reached,
+  # returned a server error or asked for requests to slow down are backed off exponentially.
+  #
+  if code is None:
+    failure = "ConnectionError"
+  elif code >= 500:
+    failure = "ServerError"
+  else:
+    failure = "ClientError"
+  
+  Thread.Lock("Framework.HTTPFailures", addToLog=False)
+  try:
+    now = time.time()
+    if cacheURL and __failureCacheTimes[failure] > 0:
+      __failedURLs[url] = now + __failureCacheTimes[failure]
+    
+    if failure != "ClientError" or code == 429:
+      host = urlparse.urlparse(url)[1]
+      failures = __failingHosts.get(host, {"Failures": 0})["Failures"] + 1
+      backoffTime = min(__hostBackoffTime * (2 ** (failures - 1)), __hostMaxBackoffTime)
+      if retryAfter is not None and retryAfter.isdigit():
+        backoffTime = max(backoffTime, min(int(retryAfter), __hostMaxBackoffTime))
+      __failingHosts[host] = {"Failures": failures, "RetryTime": now + backoffTime}
+      PMS.Log("(Framework) Backing off requests to %s for %d seconds" % (host, backoffTime))
+  finally:
+    Thread.Unlock("Framework.HTTPFailures", addToLog=False)
+
+####################################################################################################
+
+def __recordSuccess(url):
+  host = urlparse.urlparse(url)[1]
+  if __failingHosts.has_key(host) or __failedURLs.has_key(url):
+    Thread.Lock("Framework.HTTPFailures", addToLog=False)
+    try:
+      if __failingHosts.has_key(host):
+        del __failingHosts[host]
+      if __failedURLs.has_key(url):
+        del __failedURLs[url]
+    finally:
+      Thread.Unlock("Framework.HTTPFailures", addToLog=False)
+
+####################################################################################################
+
+def __staleContent(url, cachedItem, addToLog=True):
+  # Returns an expired cached copy of a page that couldn't be fetched, if there is one
+  if cachedItem is None:
+    return None
+  if addToLog: PMS.Log("(Framework) Returning the expired cached copy of %s" % url)
+  return __content(url, cachedItem, touch=False)
+
+####################################################################################################
+
+def __revalidated(url, item, cacheTime, addToLog=True, touch=True):
+  # The server says the cached copy is still current, so keep it for another cache period
+  if addToLog: PMS.Log("(Framework) Cached copy of %s is still valid" % url)
+  Thread.Lock("Framework.HTTPCache", addToLog=False)
+  try:
+    item["CheckTime"] = Datetime.Now()
     if item.has_key("UpdateTime"):
-      # Check whether the page would expire before the next cache update is triggered
-      if item["UpdateTime"] < (Datetime.Now() + Datetime.Delta(seconds=__autoUpdateCacheTime)):
-        if item.has_key("Headers"):
-          headers = item["Headers"]
-        else:
-          headers = {}
-        PMS.Log("(Framework) Automatically updating the cached copy of %s" % url)
-        Request(url, headers=headers, cacheTime=item["CacheTime"], autoUpdate=True, encoding=item["Encoding"], errors=item["Errors"], addToLog=False)
+      item["UpdateTime"] = Datetime.Now() + Datetime.Delta(seconds=cacheTime)
+      __scheduleUpdate(url, item)
+  finally:
+    Thread.Unlock("Framework.HTTPCache", addToLog=False)
+  if item.has_key("SharedKey"):
+    __sharedRevalidated(item["SharedKey"])
+  __scheduleSave()
+  return __content(url, item, touch)
+
+####################################################################################################
+
+def __scheduleUpdate(url, item, updateTime=None):
+  #
+  # Add a page to the update schedule, a heap ordered by the time each page should be updated.
+  # Updates are brought forward by a random amount so that pages cached together don't all need
+  # updating at once. Must be called with the cache locked.
+  #
+  if updateTime is None:
+    updateTime = time.mktime(item["UpdateTime"].timetuple())
+    updateTime -= random.uniform(0, min(item["CacheTime"] * 0.1, __autoUpdateCacheTime))
+  item["ScheduledUpdateTime"] = updateTime
+  heapq.heappush(__updateSchedule, (updateTime, url))
+
+####################################################################################################
+
+def __autoUpdateCachedPages():
+  # Queue the pages that would expire before the next update is triggered
+  global __autoUpdateQueue
+  if __autoUpdateQueue is None:
+    __autoUpdateQueue = Queue.Queue()
+    for i in range(__autoUpdateThreadCount):
+      Thread.__createDaemon(__autoUpdateThread)
+  
+  Thread.Lock("Framework.HTTPCache", addToLog=False)
+  try:
+    due = time.time() + __autoUpdateCacheTime
+    while len(__updateSchedule) > 0 and __updateSchedule[0][0] < due:
+      updateTime, url = heapq.heappop(__updateSchedule)
+      item = __cache.get(url)
+      
+      # Skip pages that have since been removed or rescheduled
+      if item is None or item.get("ScheduledUpdateTime") != updateTime or not item.has_key("UpdateTime"):
+        continue
+      
+      # Stop updating pages that haven't been used for a while
+      if time.time() - item.get("AccessTime", 0) > __autoUpdateIdleTime:
+        PMS.Log("(Framework) Stopped automatically updating the cached copy of %s" % url)
+        for key in ["UpdateTime", "CacheTime", "Headers", "Encoding", "Errors", "ScheduledUpdateTime"]:
+          if item.has_key(key):
+            del item[key]
+        continue
+        
+      __autoUpdateQueue.put((url, item, updateTime))
+  finally:
+    Thread.Unlock("Framework.HTTPCache", addToLog=False)
+
+####################################################################################################
+
+def __autoUpdateThread():
+  while True:
+    url, item, updateTime = __autoUpdateQueue.get()
+    try:
+      if item.has_key("Headers"):
+        headers = item["Headers"]
+      else:
+        headers = {}
+      PMS.Log("(Framework) Automatically updating the cached copy of %s" % url)
+      __request(url, headers=headers, cacheTime=item["CacheTime"], autoUpdate=True, encoding=item["Encoding"], errors=item["Errors"], addToLog=False, revalidate=True)
+    except:
+      PMS.Log("(Framework) Exception when automatically updating the cached copy of %s" % url)
+    
+    # If the update failed, try again when the next update is triggered
+    Thread.Lock("Framework.HTTPCache", addToLog=False)
+    try:
+      if __cache.get(url) is item and item.get("ScheduledUpdateTime") == updateTime:
+        __scheduleUpdate(url, item, time.time() + __autoUpdateCacheTime)
+    finally:
+      Thread.Unlock("Framework.HTTPCache", addToLog=False)
 
 ####################################################################################################
@@ -18,8 +18,8 @@ def ObjectFromString(string, encoding=None, errors=None):
   
 ####################################################################################################
   
-def ObjectFromURL(url, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None):
-  return ObjectFromString(HTTP.Request(url, values=values, headers=headers, cacheTime=cacheTime, autoUpdate=autoUpdate, encoding=encoding, errors=errors), encoding=encoding, errors=errors)
+def ObjectFromURL(url, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None, staleTime=0):
+  return ObjectFromString(HTTP.Request(url, values=values, headers=headers, cacheTime=cacheTime, autoUpdate=autoUpdate, encoding=encoding, errors=errors, staleTime=staleTime), encoding=encoding, errors=errors)
 
 ####################################################################################################
 
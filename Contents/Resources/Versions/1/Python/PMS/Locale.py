@@ -3,8 +3,8 @@
 #  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
 #
 
-import os
-import PMS, Plugin, JSON, HTTP
+import os, threading
+import PMS, Plugin, JSON, HTTP, Thread
 
 CurrentLocale = None
 
@@ -14,6 +14,11 @@ countryDict = {}
 defaultLangDict = {}
 defaultCountryDict = {}
 
+# Strings loaded for each locale, & the locale used by the request being handled on each thread.
+# The single underscore lets LocalString refer to it.
+__loadedStrings = {}
+_requestLocale = threading.local()
+
 ####################################################################################################
 
 def SetDefaultLocale(loc="en-us"):
@@ -61,13 +66,10 @@ def SetDefaultLocale(loc="en-us"):
 
 ####################################################################################################
 
-def __loadLocale(loc):
-  global CurrentLocale
-  if loc == CurrentLocale:
-    return None
-  
-  global langDict
-  global countryDict
+def __readStrings(loc):
+  # Returns the language & country strings for a locale
+  langDict = {}
+  countryDict = {}
   pos = loc.find("-")
   
   if pos > -1:
@@ -100,11 +102,48 @@ def __loadLocale(loc):
       PMS.Log("(Framework) Loaded %s strings" % loc)
     else:
       PMS.Log("(Framework) Couldn't find %s strings" % loc)
-      
+  
+  return (langDict, countryDict)
+
+####################################################################################################
+
+def __loadLocale(loc):
+  #
+  # Use the given locale for the request being handled on the current thread. Requests handled
+  # concurrently each keep their own locale - CurrentLocale is the locale set most recently.
+  #
+  global CurrentLocale
+  global langDict
+  global countryDict
+  
+  Thread.Lock("Framework.Locale", addToLog=False)
+  try:
+    if not __loadedStrings.has_key(loc):
+      __loadedStrings[loc] = __readStrings(loc)
+    strings = __loadedStrings[loc]
+  finally:
+    Thread.Unlock("Framework.Locale", addToLog=False)
+  
+  _requestLocale.locale = loc
+  _requestLocale.strings = strings
+  langDict, countryDict = strings
   CurrentLocale = loc
 
 ####################################################################################################
 
+def __keepLocale():
+  # Requests that don't specify a locale use the most recently set one for the whole request
+  _requestLocale.locale = CurrentLocale
+  _requestLocale.strings = (langDict, countryDict)
+
+####################################################################################################
+
+def __requestLocale():
+  # Returns the locale of the request being handled on the current thread
+  return getattr(_requestLocale, "locale", CurrentLocale)
+
+####################################################################################################
+
 # Subclass of str - dynamically localizes when converted to str
 class LocalString(str):
   def __init__(self, key):
@@ -122,10 +161,17 @@ class LocalString(str):
     global defaultLangDict
     global defaultCountryDict
     
-    if countryDict.has_key(key):
-      return countryDict[key]
-    elif langDict.has_key(key):
-      return langDict[key]
+    # Prefer the strings for the locale of the request being handled on this thread
+    requestStrings = getattr(_requestLocale, "strings", None)
+    if requestStrings is not None:
+      requestLangDict, requestCountryDict = requestStrings
+    else:
+      requestLangDict, requestCountryDict = langDict, countryDict
+    
+    if requestCountryDict.has_key(key):
+      return requestCountryDict[key]
+    elif requestLangDict.has_key(key):
+      return requestLangDict[key]
     elif defaultCountryDict.has_key(key):
       return defaultCountryDict[key]
     elif PMS.Locale.defaultLangDict.has_key(key):
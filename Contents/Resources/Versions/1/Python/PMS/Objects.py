@@ -4,7 +4,7 @@
 #
 
 import PMS, Plugin, XML, String, Data, __objectManager as ObjectManager
-import operator
+import operator, os
 
 ####################################################################################################
 
@@ -25,6 +25,10 @@ class Object(object):
   def Content(self):
     return None
     
+  def ContentLength(self):
+    # The length of file-like or iterable content, or None if it's unknown until the content is read
+    return None
+    
   def Status(self):
     return "200 OK"
     
@@ -155,12 +159,26 @@ class XMLContainer(XMLObject, Container):
 ####################################################################################################
 
 class DataObject(Object):
-  def __init__(self, data, contentType):
+  def __init__(self, data, contentType, length=None):
     Object.__init__(self, data=data, contentType=contentType)
     self.SetHeader("Content-Type", contentType)
+    self.__length = length
 
   def Content(self):
     return self.data
+    
+  def ContentLength(self):
+    # Data can be a string, an iterable of strings or a file-like object
+    if self.__length is not None:
+      return self.__length
+    elif isinstance(self.data, basestring):
+      return len(self.data)
+    elif hasattr(self.data, "fileno"):
+      try:
+        return os.fstat(self.data.fileno()).st_size - self.data.tell()
+      except:
+        pass
+    return None
 
 ####################################################################################################
 
@@ -324,8 +342,7 @@ class VideoItem(XMLObject):
 
 class WebVideoItem(XMLObject):
   def __init__(self, url, title=None, subtitle=None, summary=None, duration=None, thumb=None, art=None, **kwargs):
-    if Plugin.LastPrefix: prefix = Plugin.LastPrefix
-    else: prefix = Plugin.Prefixes()[0]
+    prefix = Plugin.CurrentPrefix()
     if isinstance(url, basestring):
       key = "plex://localhost/video/:/webkit?url=%s&prefix=%s" % (String.Quote(url, usePlus=True), prefix)
     else:
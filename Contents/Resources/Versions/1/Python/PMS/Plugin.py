@@ -3,14 +3,15 @@
 #  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
 #
 
-import sys, os, pickle, traceback, string, urllib, time, random, shutil
-import PMS, Locale, HTTP, XML, Database, Prefs, Data, Dict, Resource, Objects, Thread, Helper, Client, JSON
+import sys, os, pickle, traceback, string, urllib, time, random, shutil, threading, Queue, struct, StringIO, gzip, zlib
+import PMS, Locale, HTTP, XML, Database, Prefs, Data, Dict, Resource, Objects, Thread, Helper, Client, JSON, Hash
 from PMS.Shortcuts import *
-import __objectManager
+import __objectManager, __profiler, __metrics
 
 ####################################################################################################    
 
 __bundlePath = None
+__frameworkSupportFilesPath = None
 
 Identifier = None
 Debug = False
@@ -22,8 +23,30 @@ __pluginModule = None
 __logFilePath = None
 __requestHandlers = {}
 __prefixHandlers = {}
+__router = None
 LastPrefix = None
 
+__request = threading.local()
+__requestThreadCount = 0
+__requestTimeout = None
+__requestQueue = None
+
+__responseCacheTimes = {}
+__responseCache = {}
+__responseCacheSize = 0
+__responseCacheLimit = 8388608
+
+__compressionLevel = 6
+__compressionMinimumSize = 1024
+
+__framedProtocolGreeting = "PLEX-FRAMED/1"
+__framedProtocol = False
+__protocolNegotiated = False
+__streamedBody = 0xFFFFFFFF
+__abortedBody = 0xFFFFFFFE
+__taggedBody = 0xFFFFFFFD
+__responsesClosed = False
+
 __modBlacklist = []
 __modWhitelist = []
 __modChecked = []
@@ -42,11 +65,14 @@ ViewModes = {"List": 65586, "InfoList": 65592, "MediaPreview": 458803, "Showcase
 
 def AddPrefixHandler(prefix, handler, name, thumb="icon-default.png", art="art-default.png"):
   global __prefixHandlers
+  global __router
   if prefix[-1] == "/":
     prefix = prefix[:-1]
   if not __prefixHandlers.has_key(prefix):
+    __checkPrefixOverlap(prefix)
     handler_info = {"handler":handler, "name":name, "thumb":thumb, "art":art}
     __prefixHandlers[prefix] = handler_info
+    __router = None
     PMS.Log("(Framework) Added a handler for prefix '%s'" % prefix)
   else:
     PMS.Log("(Framework) Couldn't add a handler for prefix '%s' - prefix already exists" % prefix)
@@ -57,12 +83,15 @@ def AddPrefixHandler(prefix, handler, name, thumb="icon-default.png", art="art-d
   
 def AddPathRequestHandler(prefix, handler, name, thumb="icon-default.png", art="art-default.png"):
   global __requestHandlers
+  global __router
   PMS.Log("(Framework) NOTICE: Path request handlers are deprecated and will be removed in the next major framework revision.")
   if prefix[-1] == "/":
     prefix = prefix[:-1]
   if not __requestHandlers.has_key(prefix):
+    __checkPrefixOverlap(prefix)
     handler_info = {"handler":handler, "name":name, "thumb":thumb, "art":art}
     __requestHandlers[prefix] = handler_info
+    __router = None
     PMS.Log("(Framework) Added a path request handler for prefix '%s'" % prefix)
   else:
     PMS.Log("(Framework) Couldn't add a path request handler for prefix '%s' - prefix already exists" % prefix)
@@ -71,6 +100,18 @@ def AddPathRequestHandler(prefix, handler, name, thumb="icon-default.png", art="
     
 ####################################################################################################
 
+def __checkPrefixOverlap(prefix):
+  # Warn if the new prefix contains, or is contained by, a prefix that has already been registered
+  nouns = prefix.split("/")
+  for key in Prefixes():
+    if key != prefix:
+      keyNouns = key.split("/")
+      shortest = min(len(nouns), len(keyNouns))
+      if nouns[:shortest] == keyNouns[:shortest]:
+        PMS.Log("(Framework) WARNING: The prefix '%s' overlaps the prefix '%s' - requests will be routed to the longest matching prefix." % (prefix, key))
+
+####################################################################################################
+
 def AddViewGroup(name, viewMode="List", mediaType="items"):
   global __viewGroups
   if viewMode in ViewModes.keys():
@@ -96,7 +137,10 @@ def Prefixes():
 
 def CurrentPrefix():
   global LastPrefix
-  if LastPrefix: return LastPrefix
+  # Request threads track their own prefix, other threads see the last one handled
+  if hasattr(__request, "prefix"): prefix = __request.prefix
+  else: prefix = LastPrefix
+  if prefix: return prefix
   else: return Prefixes()[0]
 
 ####################################################################################################
@@ -119,6 +163,26 @@ def Traceback():
 
 ####################################################################################################
 
+def SetResponseCompression(level=6, minimumSize=1024):
+  # A level of 0 disables compression
+  global __compressionLevel
+  global __compressionMinimumSize
+  __compressionLevel = level
+  __compressionMinimumSize = minimumSize
+
+####################################################################################################
+
+def SetResponseCacheSize(size):
+  global __responseCacheLimit
+  Thread.Lock("Framework.ResponseCache", addToLog=False)
+  try:
+    __responseCacheLimit = size
+    __trimResponseCache()
+  finally:
+    Thread.Unlock("Framework.ResponseCache", addToLog=False)
+
+####################################################################################################
+
 def __setupPermissionLists():
   global __modBlacklist
   global __modWhitelist
@@ -206,10 +270,12 @@ def __run(_bundlePath):
   global Identifier
   global Debug
   global __bundlePath  
+  global __frameworkSupportFilesPath
   global __pluginModule
   global __logFilePath
   global __requestHandlers
-  global LastPrefix
+  global __requestThreadCount
+  global __requestTimeout
   
   FirstRun = False
   random.seed()
@@ -218,6 +284,7 @@ def __run(_bundlePath):
   pmsPath = "%s/Library/Application Support/Plex Media Server" % os.environ["HOME"]
   supportFilesPath = "%s/Plug-in Support" % pmsPath
   frameworkSupportFilesPath = "%s/Framework Support" % pmsPath
+  __frameworkSupportFilesPath = frameworkSupportFilesPath
   logFilesPath = "%s/Library/Logs/PMS Plugin Logs" % os.environ["HOME"]
   
   # Make sure framework directories exist
@@ -275,6 +342,21 @@ def __run(_bundlePath):
       Debug = True
       PMS.Log("(Framework) Debugging is enabled")
   except: pass
+  
+  # Check whether requests should be handled concurrently
+  try:
+    _requestThreads = infoplist.xpath('//key[text()="PlexPluginRequestThreads"]//following-sibling::string/text()')[0]
+    __requestThreadCount = max(int(_requestThreads), 0)
+    if __requestThreadCount > 0:
+      PMS.Log("(Framework) Concurrent request handling is enabled")
+  except: pass
+  
+  # Check whether HTTP requests made while handling a request should give up after a deadline
+  try:
+    _requestTimeout = infoplist.xpath('//key[text()="PlexPluginRequestTimeout"]//following-sibling::string/text()')[0]
+    __requestTimeout = float(_requestTimeout)
+    PMS.Log("(Framework) Request deadline set to %s seconds" % __requestTimeout)
+  except: pass
 
   # Log the system encoding (set during bootstrap)
   PMS.Log("(Framework) Default encoding is " + sys.getdefaultencoding())
@@ -350,184 +432,532 @@ def __run(_bundlePath):
   PMS.Log("(Framework) Attempting to start the plug-in...")
   __call(__pluginModule.Start)
   PMS.Log("(Framework) Plug-in started", False)
+  
+  # Build the router now that the plug-in's handlers have been registered
+  __buildRouter()
 
   # Start timers
   __startCacheManager(firstRun=FirstRun)
   
+  # Start the request threads if concurrent request handling is enabled
+  if __requestThreadCount > 0:
+    __startRequestThreads()
+  
   PMS.Log("(Framework) Entering run loop")
   # Enter a run loop to handle requests
   while True:
     try:
       # Read the input
-      path = raw_input()
-      path = path.lstrip("GET ").strip()
-      LastPrefix = None
+      path, headers = __readRequest()
       
-      # Read headers
-      headers = {}
-      stop = False
-      while stop == False:
-        line = raw_input()
-        if len(line) == 1:
-          stop = True
-        else:
-          split = string.split(line.strip(), ":", maxsplit=1)
-          if len(split) == 2:
-            headers[split[0].strip()] = split[1].strip()
-
-      # Set the locale
-      if headers.has_key("X-Plex-Language"):
-        loc = headers["X-Plex-Language"].lower()
-        Locale.__loadLocale(loc)
-        
-      # Set the version
-      if headers.has_key("X-Plex-Version"):
-        Client.__setVersion(headers["X-Plex-Version"])
-
-      # Extract arguments
-      kwargs = {}
-      mpath = path
-      if path.find("?") >= 0:
-        parts = path.split("?")
-        mpath = parts[0]
-        args = parts[1].split("&")
-        for arg in args:
-          kwarg = arg.split("=")
-          if len(kwarg) == 2:
-            name = urllib.unquote(kwarg[0])
-            value = urllib.unquote(kwarg[1])
-            kwargs[name] = value
-      if mpath[-1] == "/":
-        mpath = mpath[:-1]
-        
-      # Split the path into components and decode.
-      pathNouns = path.split('/')
-      pathNouns = [urllib.unquote(p) for p in pathNouns]
-      
-      # If no input was given, return an error
-      if len(pathNouns) <= 1:
-        __return("%s\r\n\r\n" % PMS.Error['BadRequest'])
+      # Requests carrying an ID can be answered out of order, so hand them to the request threads
+      if __requestQueue is not None and headers.has_key("X-Plex-Request-ID"):
+        __requestQueue.put((headers["X-Plex-Request-ID"], path, headers, time.time()))
         
-      # Otherwise, attempt to handle the request
+      # Otherwise, handle the request before reading the next one
       else:
-        result = None
-        pathNouns.pop(0)
-        count = len(pathNouns)
-        if pathNouns[-1] == "":
-          pathNouns.pop(len(pathNouns)-1)
-        PMS.Log("(Framework) Handling request :  %s" % path, False)
-        
-        # Check for a management request
-        if pathNouns[0] == ":":
-          result = __handlePMSRequest(pathNouns, path, **kwargs)
-
-        else:  
-          handler = None
-          isPrefixHandler = False
-
-          # See if there's a prefix handler available
-          for key in __prefixHandlers:
-            if mpath.count(key, 0, len(key)) == 1:
-              LastPrefix = key
-          if mpath in __prefixHandlers:
-            handler = __prefixHandlers[mpath]["handler"]
-            isPrefixHandler = True
-            
-          else:
-            # Check each request handler to see if it handles the current prefix
-            popped = False
-            for key in __requestHandlers:
-              if handler is None:
-                if path.count(key, 0, len(key)) == 1:
-                  # Remove the prefix from the path
-                  keyNounCount = len(key.split('/')) - 1
-                  for i in range(keyNounCount):
-                    pathNouns.pop(0)
-                  count = count - keyNounCount
-                  # Find the request handler
-                  handler = __requestHandlers[key]["handler"]
-                  LastPrefix = key
-                  popped = True
-            
-            # If no path request handler was found, make sure we still pop the prefix so internal requests work
-            for key in __prefixHandlers:
-              if popped == False:
-                if mpath.count(key, 0, len(key)) == 1:
-                  keyNounCount = len(key.split('/')) - 1
-                  for i in range(keyNounCount):
-                    pathNouns.pop(0)
-                  popped = True
-
-          # Check whether we should handle the request internally
-          handled = False
-          if count > 0:
-            if pathNouns[0] == ":":
-              handled = True
-              result = __handleInternalRequest(pathNouns, path, **kwargs)
-    
-          
-          # Check if the App Store has flagged the plug-in as broken
-          if os.path.exists(os.path.join(frameworkSupportFilesPath, "%s.broken" % Identifier)):
-            #TODO: Localise this bit, use message from the App Store if available
-            handled = True
-            result = PMS.Objects.MessageContainer("Please try again later", "This plug-in is currently unavailable")
-            PMS.Log("(Framework) Plug-in is flagged as broken")
-          
-          # If the request hasn't been handled, and we have a valid request handler, call it
-          else:
-            if not handled and handler is not None:
-              if isPrefixHandler:
-                result = handler(**kwargs)
-              else:
-                result = handler(pathNouns, path, **kwargs)
-        
-        # If the request wasn't handled, return an error
-        if result == None:
-          PMS.Log("(Framework) Request not handled by plug-in", False)
-          response = "%s\r\n\r\n" % PMS.Error['NotFound']
-          
-        # If the plugin returned an error, return it to PMS
-        elif result in PMS.Error.values():
-          PMS.Log("(Framework) Plug-in returned an error :  %s" % result, False)
-          response = "%s\r\n" % result
-          
-        # Otherwise, check if a valid object was returned, and return the result
-        elif __objectManager.ObjectHasBase(result, Objects.Object):
-          PMS.Log("(Framework) Response OK")
-          resultStr = result.Content()
-          resultStatus = result.Status()
-          resultHeaders = result.Headers()
-          if resultStr is not None:
-            resultLen = len(resultStr)
-            if resultLen > 0:
-              resultHeaders += "Content-Length: %i\r\n" % resultLen
-            resultStr = "\r\n%s" % resultStr
-          else:
-            resultStr = ""
-          response = str("%s\r\n%s" % (resultStatus, resultHeaders)) + str(resultStr) + str("\r\n")
-          
-        __return(response)
+        status, resultHeaders, body = __handleRequest(path, headers)
+        __return(status, resultHeaders, body)
     
     # If a KeyboardInterrupt (SIGINT) is raised, stop the plugin
     except KeyboardInterrupt:
       # Save data & exit
-      __saveData()
+      __waitForRequestThreads()
+      __saveData(force=True)
       __exit()     
     
     except EOFError:
       # Save data & exit
-      __saveData()
+      __waitForRequestThreads()
+      __saveData(force=True)
       __exit()
           
     # If another exception is raised, deal with the problem
     except:
       __except()
-      __return("%s\r\n\r\n" % PMS.Error['InternalError'])
+      __return(PMS.Error['InternalError'])
     
     # Make sure the plugin's data is saved
     finally:
       __saveData()
       
+####################################################################################################
+
+def __handleRequest(path, headers, queueWait=None):
+  #
+  # Handles a single request & returns the response status, header string & body. The header
+  # string is None when only the status line should be returned.
+  #
+  startTime = time.time()
+  
+  # HTTP requests made while handling the request share a deadline, counted from when it arrived
+  if __requestTimeout is not None:
+    HTTP.__setDeadline(startTime - (queueWait or 0) + __requestTimeout)
+  try:
+    response = __processRequest(path, headers)
+  finally:
+    HTTP.__setDeadline(None)
+  
+  # Record the time taken & the size of the response against the route that handled it
+  status, resultHeaders, body = response
+  if isinstance(body, __stream):
+    size = body.length
+  elif body is not None:
+    size = len(body)
+  else:
+    size = 0
+  __metrics.RecordRequest(__request.route, time.time() - startTime, status, size, queueWait)
+  return response
+  
+####################################################################################################
+
+def __processRequest(path, headers):
+  global LastPrefix
+  
+  __request.prefix = None
+  __request.route = None
+  LastPrefix = None
+  cacheKey = None
+  profile = None
+  
+  try:
+    # Set the locale & version for this request
+    if headers.has_key("X-Plex-Language"):
+      loc = headers["X-Plex-Language"].lower()
+      Locale.__loadLocale(loc)
+    else:
+      Locale.__keepLocale()
+      loc = Locale.__requestLocale()
+      
+    if headers.has_key("X-Plex-Version"):
+      Client.__setVersion(headers["X-Plex-Version"])
+    else:
+      Client.__keepVersion()
+
+    # Extract arguments
+    kwargs = {}
+    mpath = path
+    if path.find("?") >= 0:
+      parts = path.split("?")
+      mpath = parts[0]
+      args = parts[1].split("&")
+      for arg in args:
+        kwarg = arg.split("=")
+        if len(kwarg) == 2:
+          name = urllib.unquote(kwarg[0])
+          value = urllib.unquote(kwarg[1])
+          kwargs[name] = value
+    if mpath[-1] == "/":
+      mpath = mpath[:-1]
+      
+    # Split the path into components and decode.
+    pathNouns = path.split('/')
+    pathNouns = [urllib.unquote(p) for p in pathNouns]
+    
+    # If no input was given, return an error
+    if len(pathNouns) <= 1:
+      return (PMS.Error['BadRequest'], "", None)
+      
+    # Otherwise, attempt to handle the request
+    result = None
+    pathNouns.pop(0)
+    count = len(pathNouns)
+    if pathNouns[-1] == "":
+      pathNouns.pop(len(pathNouns)-1)
+    PMS.Log("(Framework) Handling request :  %s" % path, False)
+    
+    # Check for a management request
+    if pathNouns[0] == ":":
+      if len(pathNouns) > 1:
+        __request.route = ":/%s" % pathNouns[1].split("?")[0]
+      result = __handlePMSRequest(pathNouns, path, **kwargs)
+
+    else:  
+      # Find the handler for the path & remove the prefix from the path nouns
+      handler, isPrefixHandler, lastPrefix, keyNounCount = __route(mpath)
+      for i in range(keyNounCount):
+        pathNouns.pop(0)
+      if handler is not None and not isPrefixHandler:
+        count = count - keyNounCount
+        
+      __request.prefix = lastPrefix
+      LastPrefix = lastPrefix
+
+      # Work out which function will handle the request - requests are profiled & measured by
+      # prefix or function name
+      function = handler
+      __request.route = lastPrefix
+      if count > 0 and pathNouns[0] == ":":
+        function = None
+        if len(pathNouns) >= 4 and pathNouns[1] == "function":
+          function = __pluginModule.__dict__.get(pathNouns[2])
+          __request.route = pathNouns[2]
+        elif len(pathNouns) > 1:
+          __request.route = "%s/:/%s" % (lastPrefix, pathNouns[1].split("?")[0])
+      profile = __profiler.Begin(__request.route)
+      
+      # If the function handling the request caches its responses, try to return a cached response
+      if __responseCacheTimes.has_key(function) and not __isBroken():
+        cacheKey = (mpath, tuple(sorted(kwargs.items())), loc)
+        response = __cachedResponse(cacheKey)
+        if response is not None:
+          PMS.Log("(Framework) Returned a cached response")
+          return __finalResponse(response, headers, cacheKey)
+
+      # Check whether we should handle the request internally
+      handled = False
+      if count > 0:
+        if pathNouns[0] == ":":
+          handled = True
+          result = __handleInternalRequest(pathNouns, path, **kwargs)
+
+      
+      # Check if the App Store has flagged the plug-in as broken
+      if __isBroken():
+        #TODO: Localise this bit, use message from the App Store if available
+        handled = True
+        result = PMS.Objects.MessageContainer("Please try again later", "This plug-in is currently unavailable")
+        PMS.Log("(Framework) Plug-in is flagged as broken")
+      
+      # If the request hasn't been handled, and we have a valid request handler, call it
+      else:
+        if not handled and handler is not None:
+          if isPrefixHandler:
+            result = handler(**kwargs)
+          else:
+            result = handler(pathNouns, path, **kwargs)
+    
+    response = __response(result)
+    if cacheKey is not None:
+      __cacheResponse(cacheKey, response, __responseCacheTimes[function])
+    return __finalResponse(response, headers, cacheKey)
+  
+  # If an exception is raised, deal with the problem
+  except:
+    __except()
+    return (PMS.Error['InternalError'], "", None)
+    
+  finally:
+    __profiler.End(profile)
+  
+####################################################################################################
+
+def __response(result):
+  #
+  # Convert the result of a handler into the response status, header string & body
+  #
+  # If the request wasn't handled, return an error
+  if result == None:
+    PMS.Log("(Framework) Request not handled by plug-in", False)
+    return (PMS.Error['NotFound'], "", None)
+    
+  # If the plugin returned an error, return it to PMS
+  elif result in PMS.Error.values():
+    PMS.Log("(Framework) Plug-in returned an error :  %s" % result, False)
+    return (result, None, None)
+    
+  # Otherwise, check if a valid object was returned, and return the result
+  elif __objectManager.ObjectHasBase(result, Objects.Object):
+    PMS.Log("(Framework) Response OK")
+    resultStr = result.Content()
+    resultStatus = result.Status()
+    
+    # Tag complete responses with a hash of their content so clients can revalidate them
+    if isinstance(resultStr, basestring) and resultStatus == "200 OK":
+      if not isinstance(resultStr, str):
+        resultStr = str(resultStr)
+      result.SetHeader("ETag", "\"%s\"" % Hash.MD5(resultStr))
+      
+    resultHeaders = result.Headers()
+    if resultStr is not None:
+      # File-like & iterable content is streamed to PMS in chunks rather than read into memory
+      if hasattr(resultStr, "read") or (hasattr(resultStr, "__iter__") and not isinstance(resultStr, basestring)):
+        resultLen = result.ContentLength()
+        if resultLen is None:
+          resultHeaders += "Transfer-Encoding: chunked\r\n"
+        resultStr = __stream(resultStr, resultLen)
+      else:
+        if not isinstance(resultStr, str):
+          resultStr = str(resultStr)
+        resultLen = len(resultStr)
+      if resultLen > 0:
+        resultHeaders += "Content-Length: %i\r\n" % resultLen
+    return (str(resultStatus), str(resultHeaders), resultStr)
+  
+  # Anything else can't be returned to PMS
+  PMS.Log("(Framework) Plug-in returned an invalid response", False)
+  return (PMS.Error['InternalError'], "", None)
+
+####################################################################################################
+
+def __conditionalResponse(response, headers):
+  #
+  # If the client already has the current version of a response, return a 304 without the body
+  #
+  status, resultHeaders, body = response
+  if not headers.has_key("If-None-Match") or resultHeaders is None or not status.startswith("200"):
+    return response
+  pos = resultHeaders.find("ETag: ")
+  if pos < 0:
+    return response
+  etag = resultHeaders[pos+6:resultHeaders.find("\r\n", pos)]
+  for clientETag in headers["If-None-Match"].split(","):
+    clientETag = clientETag.strip()
+    # Compressed responses are tagged with the encoding, but match the uncompressed content
+    if clientETag == "*" or clientETag.replace("-gzip\"", "\"").replace("-deflate\"", "\"") == etag:
+      PMS.Log("(Framework) Response not modified")
+      if clientETag == "*":
+        clientETag = etag
+      return ("304 Not Modified", "ETag: %s\r\n" % clientETag, None)
+  return response
+
+####################################################################################################
+
+def __finalResponse(response, headers, cacheKey=None):
+  # Answer conditional requests, then compress the response if the client accepts it
+  response = __conditionalResponse(response, headers)
+  encoding = __acceptedEncoding(headers)
+  if encoding is not None:
+    response = __compressedResponse(response, encoding, cacheKey)
+  return response
+
+####################################################################################################
+
+def __acceptedEncoding(headers):
+  # Returns the preferred supported encoding from the Accept-Encoding header
+  if __compressionLevel <= 0 or not headers.has_key("Accept-Encoding"):
+    return None
+  accepted = []
+  for token in headers["Accept-Encoding"].split(","):
+    parts = token.split(";")
+    quality = 1.0
+    for param in parts[1:]:
+      param = param.strip()
+      if param.startswith("q="):
+        try: quality = float(param[2:])
+        except: pass
+    if quality > 0:
+      accepted.append(parts[0].strip().lower())
+  for encoding in ["gzip", "deflate"]:
+    if encoding in accepted:
+      return encoding
+  return None
+
+####################################################################################################
+
+def __compressedResponse(response, encoding, cacheKey=None):
+  #
+  # Compress a textual response body. Compressed copies of cached responses are cached alongside
+  # the original so they're only compressed once.
+  #
+  status, headers, body = response
+  if not status.startswith("200") or headers is None or not isinstance(body, str) or len(body) < __compressionMinimumSize:
+    return response
+  pos = headers.find("Content-Type: ")
+  if pos < 0:
+    return response
+  contentType = headers[pos+14:headers.find("\r\n", pos)]
+  if not (contentType.startswith("text/") or contentType.find("xml") > -1 or contentType.find("json") > -1 or contentType.find("javascript") > -1):
+    return response
+    
+  if cacheKey is not None:
+    compressed = __cachedResponse(cacheKey, encoding)
+    if compressed is not None:
+      return compressed
+  
+  if encoding == "gzip":
+    stream = StringIO.StringIO()
+    gzipper = gzip.GzipFile(fileobj=stream, mode="wb", compresslevel=__compressionLevel)
+    gzipper.write(body)
+    gzipper.close()
+    compressedBody = stream.getvalue()
+  else:
+    compressedBody = zlib.compress(body, __compressionLevel)
+  
+  headers = headers.replace("Content-Length: %i\r\n" % len(body), "Content-Length: %i\r\nContent-Encoding: %s\r\n" % (len(compressedBody), encoding))
+  pos = headers.find("ETag: ")
+  if pos > -1:
+    end = headers.find("\r\n", pos)
+    headers = "%s-%s\"%s" % (headers[:end-1], encoding, headers[end:])
+  compressed = (status, headers, compressedBody)
+  
+  if cacheKey is not None:
+    __cacheResponse(cacheKey, compressed, encoding=encoding)
+  return compressed
+
+####################################################################################################
+
+def __isBroken():
+  # Check if the App Store has flagged the plug-in as broken
+  return os.path.exists(os.path.join(__frameworkSupportFilesPath, "%s.broken" % Identifier))
+
+####################################################################################################
+
+def __setResponseCacheTime(function, cacheTime):
+  __responseCacheTimes[function] = cacheTime
+  
+####################################################################################################
+
+def __cachedResponse(key, encoding=None):
+  Thread.Lock("Framework.ResponseCache", addToLog=False)
+  try:
+    if __responseCache.has_key(key):
+      item = __responseCache[key]
+      if item["ExpiryTime"] > time.time():
+        item["AccessTime"] = time.time()
+        return item["Responses"].get(encoding)
+      __removeCachedResponse(key)
+    return None
+  finally:
+    Thread.Unlock("Framework.ResponseCache", addToLog=False)
+
+####################################################################################################
+
+def __cacheResponse(key, response, cacheTime=None, encoding=None):
+  #
+  # Only complete, successful responses are cached. Encoded copies are added to the entry for the
+  # original response.
+  #
+  global __responseCacheSize
+  status, headers, body = response
+  if not status.startswith("200") or headers is None or not isinstance(body, str):
+    return
+  size = len(headers) + len(body)
+  if size > __responseCacheLimit:
+    return
+  
+  Thread.Lock("Framework.ResponseCache", addToLog=False)
+  try:
+    if encoding is None:
+      __removeCachedResponse(key)
+      __responseCache[key] = {"Responses": {None: response}, "Size": size, "ExpiryTime": time.time() + cacheTime, "AccessTime": time.time()}
+    elif __responseCache.has_key(key):
+      item = __responseCache[key]
+      if item["Responses"].has_key(encoding):
+        return
+      item["Responses"][encoding] = response
+      item["Size"] += size
+    else:
+      return
+    __responseCacheSize += size
+    __trimResponseCache()
+  finally:
+    Thread.Unlock("Framework.ResponseCache", addToLog=False)
+
+####################################################################################################
+
+def __removeCachedResponse(key):
+  global __responseCacheSize
+  if __responseCache.has_key(key):
+    __responseCacheSize -= __responseCache[key]["Size"]
+    del __responseCache[key]
+
+####################################################################################################
+
+def __trimResponseCache():
+  # Evict the least recently used responses until the cache fits within its size limit
+  if __responseCacheSize <= __responseCacheLimit:
+    return
+  items = __responseCache.items()
+  items.sort(key=lambda item: item[1]["AccessTime"])
+  for key, item in items:
+    if __responseCacheSize <= __responseCacheLimit:
+      break
+    __removeCachedResponse(key)
+
+####################################################################################################
+
+def __buildRouter():
+  #
+  # Build a trie of path nouns from the registered prefixes, so a request can be routed with a
+  # single walk down the path instead of scanning every handler
+  #
+  global __router
+  root = {"nouns": {}, "prefix": None, "request": None}
+  for handlers, kind in ((__prefixHandlers, "prefix"), (__requestHandlers, "request")):
+    for key in handlers:
+      node = root
+      for noun in key.split("/")[1:]:
+        if not node["nouns"].has_key(noun):
+          node["nouns"][noun] = {"nouns": {}, "prefix": None, "request": None}
+        node = node["nouns"][noun]
+      node[kind] = key
+  __router = root
+  
+####################################################################################################
+
+def __route(mpath):
+  #
+  # Returns the handler for the given path (or None), whether it's a prefix handler, the prefix
+  # the path belongs to and the number of path nouns the prefix occupies
+  #
+  router = __router
+  if router is None:
+    __buildRouter()
+    router = __router
+    
+  node = router
+  prefixKey = None
+  requestKey = None
+  for noun in mpath.split("/")[1:]:
+    node = node["nouns"].get(noun)
+    if node is None:
+      break
+    if node["prefix"] is not None:
+      prefixKey = node["prefix"]
+    if node["request"] is not None:
+      requestKey = node["request"]
+  
+  # Prefix handlers only handle their exact path
+  if node is not None and node["prefix"] is not None:
+    return (__prefixHandlers[prefixKey]["handler"], True, prefixKey, 0)
+  
+  # Path request handlers handle everything below their prefix
+  if requestKey is not None:
+    return (__requestHandlers[requestKey]["handler"], False, requestKey, len(requestKey.split("/")) - 1)
+  
+  # Otherwise the prefix still needs to be removed so internal requests work
+  if prefixKey is not None:
+    return (None, False, prefixKey, len(prefixKey.split("/")) - 1)
+  return (None, False, None, 0)
+
+####################################################################################################
+
+def __startRequestThreads():
+  global __requestQueue
+  __requestQueue = Queue.Queue()
+  for i in range(__requestThreadCount):
+    Thread.__createDaemon(__requestThread)
+  PMS.Log("(Framework) Started %i request threads" % __requestThreadCount)
+
+####################################################################################################
+
+def __requestThread():
+  #
+  # Handles requests from the request queue, writing each response back with the ID of the
+  # request it answers
+  #
+  while True:
+    requestID, path, headers, queueTime = __requestQueue.get()
+    try:
+      try:
+        status, resultHeaders, body = __handleRequest(path, headers, time.time() - queueTime)
+        if resultHeaders is None:
+          resultHeaders = ""
+        __return(status, "X-Plex-Request-ID: %s\r\n%s" % (requestID, resultHeaders), body, requestID)
+      except:
+        __except()
+    finally:
+      __saveData()
+      __requestQueue.task_done()
+
+####################################################################################################
+
+def __waitForRequestThreads():
+  # Let the request threads finish any queued requests before the plug-in stops
+  if __requestQueue is not None:
+    __requestQueue.join()
+
 ####################################################################################################    
 
 def __handlePMSRequest(pathNouns, path, **kwargs):
@@ -549,6 +979,14 @@ def __handlePMSRequest(pathNouns, path, **kwargs):
         dir.Append(Objects.XMLObject(tagName="Prefix", key=key, name=handler["name"], thumb=R(handler["thumb"]), art=R(handler["art"]), hasPrefs=hasPrefs, identifier=Identifier))
       return dir
       
+    # Return the request metrics
+    elif pathNouns[1].split("?")[0] == "metrics" and len(pathNouns) == 2:
+      return Objects.DataObject(__metrics.Text(), "text/plain; version=0.0.4")
+      
+    # Control the profiler & return the profiling results
+    elif pathNouns[1].split("?")[0] == "profile":
+      return __handleProfileRequest(pathNouns, path, **kwargs)
+      
     # Set rating
     elif pathNouns[1][:4] == "rate":
       try:
@@ -561,6 +999,31 @@ def __handlePMSRequest(pathNouns, path, **kwargs):
       
 ####################################################################################################    
 
+def __handleProfileRequest(pathNouns, path, **kwargs):
+  #
+  # /:/profile returns the hottest functions of the profiled requests, while /:/profile/start,
+  # /:/profile/stop & /:/profile/reset control the profiler
+  #
+  pathNouns = path.split("?")[0].strip("/").split("/")
+  if len(pathNouns) == 2:
+    sort = kwargs.get("sort", "cumulative")
+    count = int(kwargs.get("count", 25))
+    if kwargs.get("format") == "text":
+      return Objects.DataObject(__profiler.Text(sort, count), "text/plain")
+    return __profiler.Container(sort, count)
+    
+  elif pathNouns[2] == "start":
+    __profiler.Start(kwargs.get("target"), float(kwargs.get("sampleRate", 1.0)))
+  elif pathNouns[2] == "stop":
+    __profiler.Stop()
+  elif pathNouns[2] == "reset":
+    __profiler.Reset()
+  else:
+    return None
+  return __profiler.Container(count=0)
+
+####################################################################################################    
+
 def __handleInternalRequest(pathNouns, path, **kwargs):
   #
   # Handle a request internally
@@ -570,14 +1033,14 @@ def __handleInternalRequest(pathNouns, path, **kwargs):
       if len(pathNouns) == 3:
         if Resource.__publicResources.has_key(pathNouns[2]):
           PMS.Log("(Framework) Getting resource named '%s'" % pathNouns[2])
-          resource = Resource.Load(pathNouns[2])
+          resource = Resource.Open(pathNouns[2])
           return Objects.DataObject(resource, Resource.__publicResources[pathNouns[2]])
 
     if pathNouns[1] == "sharedresources":
       if len(pathNouns) == 3:
         if Resource.__publicSharedResources.has_key(pathNouns[2]):
           PMS.Log("(Framework) Getting shared resource named '%s'" % pathNouns[2])
-          resource = Resource.LoadShared(pathNouns[2])
+          resource = Resource.OpenShared(pathNouns[2])
           return Objects.DataObject(resource, Resource.__publicSharedResources[pathNouns[2]])
 
     elif pathNouns[1] == "function" and len(pathNouns) >= 4:
@@ -656,9 +1119,239 @@ def __callNamed(functionName, addToLog=True, *args, **kwargs):
 
 ####################################################################################################
 
-def __return(string):
-  sys.stdout.write(string)
-  sys.stdout.flush()
+def __readRequest():
+  #
+  # Read the next request from PMS, returning the path & a dictionary of headers. If the first line
+  # PMS sends is the framed protocol greeting, it's echoed back & all further requests & responses
+  # are sent as length-prefixed frames instead of text.
+  #
+  global __framedProtocol
+  global __protocolNegotiated
+  if __framedProtocol:
+    return __readFramedRequest()
+    
+  line = raw_input()
+  if not __protocolNegotiated:
+    __protocolNegotiated = True
+    if line.strip() == __framedProtocolGreeting:
+      __return(__framedProtocolGreeting, None)
+      __framedProtocol = True
+      PMS.Log("(Framework) Switched to the framed request protocol")
+      return __readFramedRequest()
+  path = line.lstrip("GET ").strip()
+  
+  # Read headers
+  headers = {}
+  stop = False
+  while stop == False:
+    line = raw_input()
+    if len(line) == 1:
+      stop = True
+    else:
+      __parseHeader(line, headers)
+  return (path, headers)
+
+####################################################################################################
+
+def __readFramedRequest():
+  # A framed request is a header frame (the request line & headers) followed by a body frame
+  lines = __readFrame().split("\r\n")
+  __readFrame()
+  path = lines[0].lstrip("GET ").strip()
+  headers = {}
+  for line in lines[1:]:
+    __parseHeader(line, headers)
+  return (path, headers)
+
+####################################################################################################
+
+def __readFrame():
+  # Each frame is prefixed with its length as a 32-bit big-endian integer
+  data = sys.stdin.read(4)
+  if len(data) < 4:
+    raise EOFError
+  length = struct.unpack(">I", data)[0]
+  data = sys.stdin.read(length)
+  if len(data) < length:
+    raise EOFError
+  return data
+
+####################################################################################################
+
+def __parseHeader(line, headers):
+  split = string.split(line.strip(), ":", maxsplit=1)
+  if len(split) == 2:
+    headers[split[0].strip()] = split[1].strip()
+
+####################################################################################################
+
+class __stream(object):
+  #
+  # Wraps file-like or iterable response content. Iterating over the stream yields the content in
+  # chunks & closes the source once it's exhausted.
+  #
+  # The headers have already been sent by the time the content is read, so an error raised by the
+  # source ends the stream instead of propagating, and marks it as failed. So does content that
+  # doesn't match the stream's length.
+  #
+  def __init__(self, content, length=None, chunkSize=65536):
+    self.content = content
+    self.length = length
+    self.chunkSize = chunkSize
+    self.failed = False
+    
+  def __iter__(self):
+    sent = 0
+    chunks = self.__chunks()
+    while True:
+      try:
+        chunk = chunks.next()
+      except StopIteration:
+        break
+      except Exception:
+        PMS.Log("(Framework) Streamed response ended early:\n%s" % traceback.format_exc())
+        self.failed = True
+        break
+      if self.length is not None and sent + len(chunk) > self.length:
+        PMS.Log("(Framework) Streamed response is longer than its length of %i bytes" % self.length)
+        chunks.close()
+        self.failed = True
+        break
+      sent += len(chunk)
+      yield chunk
+    
+    if self.length is not None and sent < self.length and not self.failed:
+      PMS.Log("(Framework) Streamed response is shorter than its length of %i bytes" % self.length)
+      self.failed = True
+    
+  def __chunks(self):
+    try:
+      if hasattr(self.content, "read"):
+        while True:
+          chunk = self.content.read(self.chunkSize)
+          if not chunk:
+            break
+          yield chunk
+      else:
+        for chunk in self.content:
+          if chunk:
+            yield str(chunk)
+    finally:
+      if hasattr(self.content, "close"):
+        self.content.close()
+
+####################################################################################################
+
+def __return(status, headers="", body=None, requestID=None):
+  #
+  # Write a response to PMS. Request threads share stdout, so each response is written under a lock.
+  #
+  if __framedProtocol and requestID is not None and isinstance(body, __stream):
+    __returnTagged(status, headers, body, requestID)
+    return
+  
+  Thread.Lock("Framework.Response", addToLog=False)
+  try:
+    if __responsesClosed:
+      return
+    if __framedProtocol:
+      if headers is None:
+        headers = ""
+      if body is None:
+        body = ""
+      headerBlock = "%s\r\n%s" % (status, headers)
+      sys.stdout.write(struct.pack(">I", len(headerBlock)))
+      sys.stdout.write(headerBlock)
+      if isinstance(body, __stream):
+        # Streams are sent as a series of frames, ending with an empty one - or with an abort frame if
+        # the content couldn't be read in full
+        sys.stdout.write(struct.pack(">I", __streamedBody))
+        for chunk in body:
+          sys.stdout.write(struct.pack(">I", len(chunk)))
+          sys.stdout.write(chunk)
+        if body.failed:
+          sys.stdout.write(struct.pack(">I", __abortedBody))
+        else:
+          sys.stdout.write(struct.pack(">I", 0))
+      else:
+        sys.stdout.write(struct.pack(">I", len(body)))
+        sys.stdout.write(body)
+    else:
+      sys.stdout.write("%s\r\n" % status)
+      if headers is not None:
+        sys.stdout.write("%s\r\n" % headers)
+        if body is not None:
+          if isinstance(body, __stream):
+            # Streams of unknown length use HTTP chunked encoding
+            for chunk in body:
+              if body.length is None:
+                sys.stdout.write("%x\r\n" % len(chunk))
+                sys.stdout.write(chunk)
+                sys.stdout.write("\r\n")
+              else:
+                sys.stdout.write(chunk)
+            if body.failed:
+              __closeResponses()
+              return
+            if body.length is None:
+              sys.stdout.write("0\r\n\r\n")
+          else:
+            sys.stdout.write(body)
+          sys.stdout.write("\r\n")
+    sys.stdout.flush()
+  finally:
+    Thread.Unlock("Framework.Response", addToLog=False)
+
+####################################################################################################
+
+def __returnTagged(status, headers, body, requestID):
+  #
+  # Write a streamed response in the framed protocol without holding the response lock while the
+  # content is read, so responses to other requests can be sent in the meantime. The header frame
+  # is followed by a body length of __taggedBody, then each chunk is sent as a separate message
+  # tagged with the request's ID - a "CHUNK" header frame & a frame holding the chunk. An empty chunk
+  # ends the body, or an "ABORT" message if the content couldn't be read in full.
+  #
+  tag = "X-Plex-Request-ID: %s\r\n" % requestID
+  headerBlock = "%s\r\n%s" % (status, headers or "")
+  __write(struct.pack(">I", len(headerBlock)) + headerBlock + struct.pack(">I", __taggedBody))
+  chunkHeader = "CHUNK\r\n%s" % tag
+  for chunk in body:
+    __write(struct.pack(">I", len(chunkHeader)) + chunkHeader + struct.pack(">I", len(chunk)) + chunk)
+  if body.failed:
+    endHeader = "ABORT\r\n%s" % tag
+  else:
+    endHeader = chunkHeader
+  __write(struct.pack(">I", len(endHeader)) + endHeader + struct.pack(">I", 0))
+
+####################################################################################################
+
+def __write(data):
+  # Write a complete message to PMS under the response lock
+  Thread.Lock("Framework.Response", addToLog=False)
+  try:
+    if not __responsesClosed:
+      sys.stdout.write(data)
+      sys.stdout.flush()
+  finally:
+    Thread.Unlock("Framework.Response", addToLog=False)
+
+####################################################################################################
+
+def __closeResponses():
+  #
+  # The text protocol can't mark a response as failed once its headers have been sent, so the pipe
+  # to PMS is closed instead of completing the response. PMS sees the response cut short & stops
+  # the plug-in. Called with the response lock held.
+  #
+  global __responsesClosed
+  __responsesClosed = True
+  PMS.Log("(Framework) Closing the connection to PMS after a failed response", False)
+  try:
+    sys.stdout.flush()
+    os.close(sys.stdout.fileno())
+  except:
+    pass
 
 ####################################################################################################
 
@@ -671,9 +1364,10 @@ def __except():
     
 ####################################################################################################
 
-def __saveData():
+def __saveData(force=False):
+  # Commit database changes according to the commit policy, or immediately if forced
   if Database.__changed and Database.__db is not None:
-    Database.Commit()
+    Database.__groupCommit(force)
     
 ####################################################################################################
 
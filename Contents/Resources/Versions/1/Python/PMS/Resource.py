@@ -75,6 +75,22 @@ def LoadShared(itemName, binary=False):
 
 ####################################################################################################
 
+def Open(itemName):
+  path = "%s/%s" % (__resourcePath, itemName)
+  if os.path.exists(path):
+    PMS.Log("(Framework) Opened resource named '%s'" % itemName)
+    return open(path, "rb")
+
+####################################################################################################
+
+def OpenShared(itemName):
+  path = "%s/%s" % (__sharedResourcePath, itemName)
+  if os.path.exists(path):
+    PMS.Log("(Framework) Opened shared resource named '%s'" % itemName)
+    return open(path, "rb")
+
+####################################################################################################
+
 def ExternalPath(itemName):
   if len(Plugin.Prefixes()) == 0: return None
   global __publicResources
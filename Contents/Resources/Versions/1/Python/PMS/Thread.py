@@ -27,6 +27,15 @@ def Create(function, *args, **kwargs):
 
 ####################################################################################################
 
+def __createDaemon(function, *args, **kwargs):
+  # Framework worker threads shouldn't keep the plug-in process alive once the run loop exits
+  th = _threading.Thread(None, function, None, args, kwargs)
+  th.setDaemon(True)
+  th.start()
+  return th
+
+####################################################################################################
+
 def CreateTimer(interval, function, *args, **kwargs):
   a = list(args)
   a.insert(0, function)
@@ -41,8 +50,9 @@ def CreateTimer(interval, function, *args, **kwargs):
 def Lock(key, addToLog=True):
   global __locks
   try:
+    # setdefault is atomic, so threads racing to create the same lock end up sharing one
     if not __locks.has_key(key):
-      __locks[key] = _threading.Lock()
+      __locks.setdefault(key, _threading.Lock())
     if addToLog:
       PMS.Log("(Framework) Acquiring the thread lock '%s'" % key)
     __locks[key].acquire()
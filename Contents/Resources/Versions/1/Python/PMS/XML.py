@@ -19,8 +19,8 @@ def Element(name, text=None, **kwargs):
 
 ####################################################################################################
   
-def ElementFromURL(url, isHTML=False, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None):
-  return ElementFromString(HTTP.Request(url, values, headers, cacheTime, autoUpdate, encoding, errors), isHTML)
+def ElementFromURL(url, isHTML=False, values=None, headers={}, cacheTime=None, autoUpdate=False, encoding=None, errors=None, staleTime=0):
+  return ElementFromString(HTTP.Request(url, values, headers, cacheTime, autoUpdate, encoding, errors, staleTime=staleTime), isHTML)
 
 ####################################################################################################
 
@@ -0,0 +1,124 @@
+#
+#  Plex Media Framework
+#  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
+#
+
+import PMS, Thread
+
+__latencyBuckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+__quantiles = [0.5, 0.9, 0.99]
+__sampleCount = 1000
+
+__routes = {}
+__queueWait = None
+
+####################################################################################################
+
+def __histogram():
+  return {"Buckets": [0] * len(__latencyBuckets), "Count": 0, "Sum": 0.0}
+
+####################################################################################################
+
+def __observe(histogram, value):
+  for i in range(len(__latencyBuckets)):
+    if value <= __latencyBuckets[i]:
+      histogram["Buckets"][i] += 1
+  histogram["Count"] += 1
+  histogram["Sum"] += value
+
+####################################################################################################
+
+def __label(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+####################################################################################################
+
+def __histogramLines(name, histogram, labels=""):
+  lines = []
+  for i in range(len(__latencyBuckets)):
+    lines.append("%s_bucket{%sle=\"%s\"} %i" % (name, labels, __latencyBuckets[i], histogram["Buckets"][i]))
+  lines.append("%s_bucket{%sle=\"+Inf\"} %i" % (name, labels, histogram["Count"]))
+  if labels:
+    labels = "{%s}" % labels.rstrip(",")
+  lines.append("%s_sum%s %f" % (name, labels, histogram["Sum"]))
+  lines.append("%s_count%s %i" % (name, labels, histogram["Count"]))
+  return lines
+
+####################################################################################################
+
+def RecordRequest(route, duration, status, size=None, queueWait=None):
+  #
+  # Record a handled request. Latencies are kept in a histogram, plus a window of the most recent
+  # samples used to work out percentiles.
+  #
+  global __queueWait
+  if route is None:
+    route = "none"
+  Thread.Lock("Framework.Metrics", addToLog=False)
+  try:
+    if not __routes.has_key(route):
+      __routes[route] = {"Latency": __histogram(), "Samples": [], "NextSample": 0, "Errors": {}, "ResponseBytes": 0, "Responses": 0}
+    metrics = __routes[route]
+    __observe(metrics["Latency"], duration)
+    if len(metrics["Samples"]) < __sampleCount:
+      metrics["Samples"].append(duration)
+    else:
+      metrics["Samples"][metrics["NextSample"]] = duration
+      metrics["NextSample"] = (metrics["NextSample"] + 1) % __sampleCount
+
+    statusCode = status.split(" ")[0]
+    if statusCode[:1] in ["4", "5"]:
+      metrics["Errors"][statusCode] = metrics["Errors"].get(statusCode, 0) + 1
+
+    if size is not None:
+      metrics["ResponseBytes"] += size
+      metrics["Responses"] += 1
+
+    if queueWait is not None:
+      if __queueWait is None:
+        __queueWait = __histogram()
+      __observe(__queueWait, queueWait)
+  finally:
+    Thread.Unlock("Framework.Metrics", addToLog=False)
+
+####################################################################################################
+
+def Text():
+  # Returns the recorded metrics in the plain text exposition format
+  Thread.Lock("Framework.Metrics", addToLog=False)
+  try:
+    routes = __routes.keys()
+    routes.sort()
+
+    lines = ["# HELP plugin_request_duration_seconds Time taken to handle requests.", "# TYPE plugin_request_duration_seconds histogram"]
+    for route in routes:
+      lines.extend(__histogramLines("plugin_request_duration_seconds", __routes[route]["Latency"], "route=\"%s\"," % __label(route)))
+
+    lines.extend(["# HELP plugin_request_latency_seconds Percentiles of the most recent request latencies.", "# TYPE plugin_request_latency_seconds gauge"])
+    for route in routes:
+      samples = list(__routes[route]["Samples"])
+      samples.sort()
+      for quantile in __quantiles:
+        value = samples[min(int(quantile * len(samples)), len(samples) - 1)]
+        lines.append("plugin_request_latency_seconds{route=\"%s\",quantile=\"%s\"} %f" % (__label(route), quantile, value))
+
+    lines.extend(["# HELP plugin_request_errors_total Requests answered with an error status.", "# TYPE plugin_request_errors_total counter"])
+    for route in routes:
+      errors = __routes[route]["Errors"]
+      for statusCode in errors:
+        lines.append("plugin_request_errors_total{route=\"%s\",status=\"%s\"} %i" % (__label(route), statusCode, errors[statusCode]))
+
+    lines.extend(["# HELP plugin_response_size_bytes Size of response bodies.", "# TYPE plugin_response_size_bytes summary"])
+    for route in routes:
+      lines.append("plugin_response_size_bytes_sum{route=\"%s\"} %i" % (__label(route), __routes[route]["ResponseBytes"]))
+      lines.append("plugin_response_size_bytes_count{route=\"%s\"} %i" % (__label(route), __routes[route]["Responses"]))
+
+    if __queueWait is not None:
+      lines.extend(["# HELP plugin_request_queue_wait_seconds Time requests spent queued for a request thread.", "# TYPE plugin_request_queue_wait_seconds histogram"])
+      lines.extend(__histogramLines("plugin_request_queue_wait_seconds", __queueWait))
+
+    return "\n".join(lines) + "\n"
+  finally:
+    Thread.Unlock("Framework.Metrics", addToLog=False)
+
+####################################################################################################
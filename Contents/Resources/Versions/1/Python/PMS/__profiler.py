@@ -0,0 +1,115 @@
+#
+#  Plex Media Framework
+#  Copyright (C) 2008-2009 Plex Development Team (James Clarke, Elan Feingold). All Rights Reserved.
+#
+
+import PMS, Thread, Objects, cProfile, pstats, random, StringIO
+
+__enabled = False
+__target = None
+__sampleRate = 1.0
+__stats = None
+__profiledRequests = 0
+
+__sortColumns = {"calls": 1, "time": 2, "cumulative": 3}
+
+####################################################################################################
+
+def Start(target=None, sampleRate=1.0):
+  # Profile requests for the given prefix or function name, or all requests if no target is given
+  global __enabled
+  global __target
+  global __sampleRate
+  __target = target
+  __sampleRate = sampleRate
+  __enabled = True
+  PMS.Log("(Framework) Started profiling requests (target: %s, sample rate: %s)" % (target, sampleRate))
+
+####################################################################################################
+
+def Stop():
+  global __enabled
+  __enabled = False
+  PMS.Log("(Framework) Stopped profiling requests")
+
+####################################################################################################
+
+def Reset():
+  global __stats
+  global __profiledRequests
+  Thread.Lock("Framework.Profiler", addToLog=False)
+  __stats = None
+  __profiledRequests = 0
+  Thread.Unlock("Framework.Profiler", addToLog=False)
+
+####################################################################################################
+
+def Begin(route):
+  # Returns an enabled profile if the request for the given route should be sampled
+  if not __enabled or route is None:
+    return None
+  if __target is not None and route != __target:
+    return None
+  if random.random() >= __sampleRate:
+    return None
+  profile = cProfile.Profile()
+  profile.enable()
+  return profile
+
+####################################################################################################
+
+def End(profile):
+  # Stop the profile & add it to the aggregated stats
+  global __stats
+  global __profiledRequests
+  if profile is None:
+    return
+  profile.disable()
+  Thread.Lock("Framework.Profiler", addToLog=False)
+  try:
+    if __stats is None:
+      __stats = pstats.Stats(profile)
+    else:
+      __stats.add(profile)
+    __profiledRequests += 1
+  finally:
+    Thread.Unlock("Framework.Profiler", addToLog=False)
+
+####################################################################################################
+
+def Container(sort="cumulative", count=25):
+  # Returns the top functions as a MediaContainer
+  if not __sortColumns.has_key(sort):
+    sort = "cumulative"
+  dir = Objects.MediaContainer(enabled=__enabled, target=__target, sampleRate=__sampleRate, requests=__profiledRequests)
+  Thread.Lock("Framework.Profiler", addToLog=False)
+  try:
+    if __stats is None:
+      return dir
+    column = __sortColumns[sort]
+    entries = __stats.stats.items()
+    entries.sort(key=lambda entry: entry[1][column], reverse=True)
+    for (filename, line, name), (primitiveCalls, calls, totalTime, cumulativeTime, callers) in entries[:count]:
+      dir.Append(Objects.XMLObject(tagName="Function", name=name, file=filename, line=line, calls=calls, primitiveCalls=primitiveCalls, totalTime="%.6f" % totalTime, cumulativeTime="%.6f" % cumulativeTime))
+  finally:
+    Thread.Unlock("Framework.Profiler", addToLog=False)
+  return dir
+
+####################################################################################################
+
+def Text(sort="cumulative", count=25):
+  # Returns the top functions in pstats' text format
+  if not __sortColumns.has_key(sort):
+    sort = "cumulative"
+  Thread.Lock("Framework.Profiler", addToLog=False)
+  try:
+    if __stats is None:
+      return "No requests have been profiled\n"
+    stream = StringIO.StringIO()
+    __stats.stream = stream
+    __stats.sort_stats(sort).print_stats(count)
+    return stream.getvalue()
+  finally:
+    Thread.Unlock("Framework.Profiler", addToLog=False)
+
+####################################################################################################